@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+DEFAULT_KEYBOARD = 'HAOBO Technology USB Composite Device Keyboard'
+
+# What the keys, buttons and presets did before they came from app.conf
+DEFAULT_KEYS = {
+    'KEY_UP': {'action': 'nudge_grade', 'value': 0.5},
+    'KEY_DOWN': {'action': 'nudge_grade', 'value': -0.5},
+    'KEY_LEFT': {'action': 'nudge_speed', 'value': -0.2},
+    'KEY_RIGHT': {'action': 'nudge_speed', 'value': 0.2},
+    'KEY_SELECT': {'action': 'select'},
+    'KEY_HOMEPAGE': {'action': 'reset'},
+}
+
+DEFAULT_PRESETS = {
+    'normal': {'speed': 4.0, 'grade': 15.0},
+    'fast': {'speed': 5.0, 'grade': 15.0},
+}
+
+DEFAULT_BUTTONS = [
+    {'label': 'Normal', 'icon': 'looks_one', 'action': 'preset', 'value': 'normal'},
+    {'label': 'HIIT IT', 'icon': 'keyboard_double_arrow_right', 'action': 'hiit',
+     'value': {'speed': 8.0, 'duration': 60.0}},
+    {'label': 'Fast', 'icon': 'looks_two', 'action': 'preset', 'value': 'fast'},
+]
+
+# Actions whose repeats are added up by the keyboard, see NudgeBatcher
+NUDGES = ('nudge_speed', 'nudge_grade')
+
+def do_select(service, value):
+    """ The keyboard's select key: start when idle, otherwise flip
+        between walking and running
+    """
+    if service.status == 'idle':
+        service.spawn(service.go_start())
+    elif service.status == 'running':
+        log.info("Move to walking")
+        service.go_walk()
+    elif service.status == 'walking':
+        log.info("Move to running")
+        service.go_run()
+
+ACTIONS = {
+    'nudge_speed': lambda service, value: service.nudge_speed(float(value)),
+    'nudge_grade': lambda service, value: service.nudge_grade(float(value)),
+    'speed': lambda service, value: service.speed_change(float(value)),
+    'grade': lambda service, value: service.grade_change(float(value)),
+    'program': lambda service, value: service.go_program(value),
+    'stop_program': lambda service, value: service.stop_program(),
+    'hiit': lambda service, value: service.go_hiit(**(value or {})),
+    'start': lambda service, value: service.spawn(service.go_start()),
+    'stop': lambda service, value: service.go_stop(),
+    'reset': lambda service, value: service.do_reset(),
+    'walk': lambda service, value: service.go_walk(),
+    'run': lambda service, value: service.go_run(),
+    'select': do_select,
+    'log': lambda service, value: log.info("%s", value),
+}
+
+class Bindings:
+    """ The keys, UI buttons and presets from app.conf. `keys` maps key
+        names (as in evdev.ecodes) to an action and its value, so whoever
+        reads the keyboard can turn them into a scancode dict once per load.
+        watch() reloads the file when it changes and tells the listeners,
+        a broken edit keeps the previous bindings. Presets and `programs`
+        are checked by name when the file is loaded, not on the key press.
+    """
+    def __init__(self, path='app.conf', programs=None):
+        self.path = path
+        self.programs = programs or {}
+        self.mtime = None
+        self.keyboard_name = DEFAULT_KEYBOARD
+        self.keys = dict(DEFAULT_KEYS)
+        self.presets = dict(DEFAULT_PRESETS)
+        self.buttons = list(DEFAULT_BUTTONS)
+        self.listeners = []
+        self.load()
+
+    def load(self):
+        try:
+            self.mtime = os.stat(self.path).st_mtime
+            with open(self.path) as f:
+                config = yaml.safe_load(f) or {}
+            keyboard = config.get('keyboard') or {}
+            keys = dict(keyboard.get('keys') or DEFAULT_KEYS)
+            presets = dict(config.get('presets') or DEFAULT_PRESETS)
+            buttons = list(config.get('buttons') or DEFAULT_BUTTONS)
+            for binding in list(keys.values()) + buttons:
+                action = binding.get('action')
+                if action not in ACTIONS and action != 'preset':
+                    raise ValueError(f"Unknown action '{action}'")
+                if action == 'preset' and binding.get('value') not in presets:
+                    raise ValueError(f"No preset called '{binding.get('value')}'")
+                if action == 'program' and binding.get('value') not in self.programs:
+                    raise ValueError(f"No program called '{binding.get('value')}'")
+        except Exception as ex:
+            log.error("Could not load the bindings from %s: %s", self.path, ex)
+            return False
+
+        self.keyboard_name = keyboard.get('device', DEFAULT_KEYBOARD)
+        self.keys = keys
+        self.presets = presets
+        self.buttons = buttons
+        return True
+
+    def on_reload(self, listener):
+        self.listeners.append(listener)
+
+    def run(self, service, action, value=None):
+        """ Does `action` on `service`, the device being controlled
+        """
+        if action == 'preset':
+            preset = self.presets.get(value)
+            if preset is None:
+                log.warning("No preset called '%s'", value)
+                return
+            if 'grade' in preset:
+                service.grade_change(float(preset['grade']))
+            if 'speed' in preset:
+                service.speed_change(float(preset['speed']))
+            return
+        return ACTIONS[action](service, value)
+
+    def check(self):
+        """ Reloads the file if it changed since it was last loaded
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        if self.load():
+            log.info("Reloaded the key and button bindings from %s", self.path)
+            for listener in self.listeners:
+                try:
+                    listener()
+                except Exception as ex:
+                    log.error("Bindings listener failed: %s", ex)
+        else:
+            # Don't try the broken file again until it changes
+            self.mtime = mtime
+
+    async def watch(self, interval=2.0):
+        """ Checks the file for changes every `interval` seconds
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.check()
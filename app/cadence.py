@@ -0,0 +1,115 @@
+import asyncio
+import bisect
+import threading
+import time
+
+# Treadmill states where nothing is moving and polls can be far apart
+IDLE_STATES = ('idle', 'ready', 'finished', 'manual', 'offline')
+
+class PollCadence:
+    """ Decides how long the monitor waits before the next poll.
+
+        - `idle_interval` while the treadmill is idle, ready or finished
+        - `interval` while it's in use
+        - `fast_interval` for `boost_time` seconds after a command, and from
+          `lead` seconds before a program step until `boost_time` after it
+
+        The wait is measured from when the poll started, so the time the
+        serial round trip took comes off it rather than adding to it. No
+        interval goes below `rtt_factor` times the measured round trip, or
+        below `min_interval`, which the registry sets so that all devices
+        together stay within the polls per second budget.
+
+        boost() and expect() can be called from any thread, and wake the
+        monitor up if it's in the middle of a long idle wait.
+    """
+    def __init__(self, interval=0.2, fast_interval=0.1, idle_interval=2.0,
+                 boost_time=3.0, lead=1.0, rtt_factor=2.0):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.boost_time = boost_time
+        self.lead = lead
+        self.rtt_factor = rtt_factor
+        self.min_interval = 0.0
+
+        self.lock = threading.Lock()
+        self.fast_until = 0.0
+        # Monotonic times of upcoming program steps, sorted
+        self.transitions = []
+        # Smoothed serial round trip
+        self.rtt = None
+
+        self.loop = None
+        self.wakeup = None
+
+    def boost(self, seconds=None):
+        """ Polls fast for a while, something just changed
+        """
+        with self.lock:
+            self.fast_until = max(self.fast_until, time.monotonic() + (seconds or self.boost_time))
+        self.wake()
+
+    def expect(self, times):
+        """ Polls fast around each of `times` (monotonic), replacing the
+            ones expected before
+        """
+        with self.lock:
+            self.transitions = sorted(times)
+        self.wake()
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def observe(self, latency):
+        """ Takes the serial round trip of the last poll
+        """
+        if self.rtt is None:
+            self.rtt = latency
+        else:
+            self.rtt += 0.2 * (latency - self.rtt)
+
+    def current(self, status, now=None):
+        """ The interval to poll at right now
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            # Forget the steps that are long past
+            done = bisect.bisect_left(self.transitions, now - self.boost_time)
+            if done:
+                del self.transitions[:done]
+            near_step = bool(self.transitions) and self.transitions[0] - self.lead <= now
+            fast = now < self.fast_until or near_step
+
+        if fast:
+            interval = self.fast_interval
+        elif status in IDLE_STATES:
+            interval = self.idle_interval
+        else:
+            interval = self.interval
+        if self.rtt is not None:
+            interval = max(interval, self.rtt * self.rtt_factor)
+        return max(interval, self.min_interval)
+
+    async def sleep(self, status, started):
+        """ Waits until the next poll is due, `started` being when the last
+            one was sent (monotonic). A boost() or expect() while waiting
+            brings the poll forward
+        """
+        if self.wakeup is None:
+            self.loop = asyncio.get_running_loop()
+            self.wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            delay = self.current(status, now) - (now - started)
+            if delay <= 0:
+                # Give the event loop a turn even when we're behind
+                await asyncio.sleep(0)
+                return
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                return
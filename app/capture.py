@@ -0,0 +1,139 @@
+import struct
+import time
+import zlib
+
+# CSAFE state machine codes, so the status column fits in a byte
+STATUS_CODES = {
+    'error': 0,
+    'ready': 1,
+    'idle': 2,
+    'haveid': 3,
+    'inuse': 5,
+    'paused': 6,
+    'finished': 7,
+    'manual': 8,
+    'offline': 9,
+}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+UNKNOWN_STATUS = 15
+
+CHUNK_VERSION = 1
+COLUMNS = ('timestamp', 'status', 'speed', 'grade', 'latency')
+
+def write_varint(buf:bytearray, value:int):
+    """ Zigzag encodes `value` then appends it as a LEB128 varint
+    """
+    value = (value << 1) ^ (value >> 63)
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return
+
+def read_varint(buf, offset:int):
+    """ Returns (value, new offset) for the varint at `offset`
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), offset
+
+def encode_chunk(start:float, columns):
+    """ Packs the columns as delta encoded varints, compressed with zlib.
+        Timestamps are in milliseconds relative to `start`
+    """
+    count = len(columns[0])
+    buf = bytearray()
+    buf.append(CHUNK_VERSION)
+    buf += struct.pack('<d', start)
+    write_varint(buf, count)
+    for column in columns:
+        previous = 0
+        for value in column:
+            write_varint(buf, value - previous)
+            previous = value
+    return zlib.compress(bytes(buf))
+
+def decode_chunk(payload:bytes):
+    """ Unpacks a chunk back into a list of sample dicts
+    """
+    buf = zlib.decompress(payload)
+    if buf[0] != CHUNK_VERSION:
+        raise ValueError(f"Unknown chunk version {buf[0]}")
+    start, = struct.unpack_from('<d', buf, 1)
+    count, offset = read_varint(buf, 9)
+    columns = []
+    for _ in COLUMNS:
+        column = []
+        previous = 0
+        for _ in range(count):
+            delta, offset = read_varint(buf, offset)
+            previous += delta
+            column.append(previous)
+        columns.append(column)
+    return [
+        {
+            'timestamp': start + timestamp / 1000,
+            'status': STATUS_NAMES.get(status, 'unknown'),
+            'speed': speed / 10,
+            'grade': grade / 100,
+            'latency': latency / 10000,
+        }
+        for timestamp, status, speed, grade, latency in zip(*columns)
+    ]
+
+
+class Capture:
+    """ Keeps every status poll at full resolution. Samples are collected
+        column by column and handed to the writer as one delta encoded chunk
+        every `chunk_seconds`, so a constant speed costs about a byte per
+        column per sample and one insert per chunk.
+    """
+    def __init__(self, writer, device=None, chunk_seconds=60.0, max_samples=1000):
+        self.writer = writer
+        self.device = device
+        self.chunk_seconds = chunk_seconds
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.columns = tuple([] for _ in COLUMNS)
+
+    def add(self, status:str, speed:float, grade:float, latency:float, timestamp:float=None):
+        """ Records one poll. `latency` is the poll's wall clock time in seconds
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.start is None:
+            self.start = timestamp
+        timestamps, statuses, speeds, grades, latencies = self.columns
+        timestamps.append(int(round((timestamp - self.start) * 1000)))
+        statuses.append(STATUS_CODES.get(status, UNKNOWN_STATUS))
+        speeds.append(int(round(speed * 10)))
+        grades.append(int(round(grade * 100)))
+        latencies.append(int(round(latency * 10000)))
+
+        if timestamp - self.start >= self.chunk_seconds \
+           or len(timestamps) >= self.max_samples:
+            self.flush()
+
+    def flush(self):
+        """ Encodes whatever has been collected and queues it for writing
+        """
+        timestamps = self.columns[0]
+        if not timestamps:
+            return
+        end = self.start + timestamps[-1] / 1000
+        payload = encode_chunk(self.start, self.columns)
+        self.writer.put_chunk(self.start, end, len(timestamps), payload, device=self.device)
+        self.reset()
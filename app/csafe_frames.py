@@ -0,0 +1,183 @@
+""" Just enough of the CSAFE framing to send several commands in a single
+    frame. The csafe Controller only sends one command per frame, which
+    costs a full round trip on the 9600 baud link for every value we poll.
+"""
+
+from app.metrics import SERIAL_ERRORS, SERIAL_TIMEOUTS
+
+EXTENDED_START = 0xF0
+START = 0xF1
+STOP = 0xF2
+STUFF = 0xF3
+
+CMD_GET_STATUS = 0x80
+CMD_RESET = 0x81
+CMD_GO_IDLE = 0x82
+CMD_GO_HAVE_ID = 0x83
+CMD_GO_IN_USE = 0x85
+CMD_GO_FINISHED = 0x86
+CMD_GO_READY = 0x87
+CMD_GET_ID = 0x92
+CMD_GET_SPEED = 0xA5
+CMD_GET_GRADE = 0xA8
+CMD_SET_SPEED = 0x25
+CMD_SET_GRADE = 0x28
+
+STATES = {
+    0: 'error',
+    1: 'ready',
+    2: 'idle',
+    3: 'haveid',
+    5: 'inuse',
+    6: 'paused',
+    7: 'finished',
+    8: 'manual',
+    9: 'offline',
+}
+
+# Unit code: (name, multiplier to km/h or % grade)
+UNITS = {
+    0x10: ('mile/hour', 1.609344),
+    0x11: ('0.1 mile/hour', 0.1609344),
+    0x12: ('0.01 mile/hour', 0.01609344),
+    0x30: ('km/hour', 1.0),
+    0x31: ('0.1 km/hour', 0.1),
+    0x32: ('0.01 km/hour', 0.01),
+    0x4A: ('% grade', 1.0),
+    0x4B: ('0.01 % grade', 0.01),
+    0x4C: ('0.1 % grade', 0.1),
+}
+
+class FrameError(Exception):
+    pass
+
+class FrameTimeout(FrameError):
+    """ No response at all, as opposed to a bad one
+    """
+
+def stuff(data):
+    """ Byte stuffs the frame contents so no flag bytes appear inside it
+    """
+    buf = bytearray()
+    for byte in data:
+        if EXTENDED_START <= byte <= STUFF:
+            buf.append(STUFF)
+            buf.append(byte & 0x03)
+        else:
+            buf.append(byte)
+    return bytes(buf)
+
+def unstuff(data):
+    buf = bytearray()
+    escaped = False
+    for byte in data:
+        if escaped:
+            buf.append(EXTENDED_START | byte)
+            escaped = False
+        elif byte == STUFF:
+            escaped = True
+        else:
+            buf.append(byte)
+    return bytes(buf)
+
+def checksum(data):
+    value = 0
+    for byte in data:
+        value ^= byte
+    return value
+
+def encode_frame(contents):
+    """ Wraps the raw contents in a standard CSAFE frame
+        with checksum and start/stop flags
+    """
+    contents = bytes(contents)
+    return bytes([START]) + stuff(contents + bytes([checksum(contents)])) + bytes([STOP])
+
+def decode_frame(frame):
+    """ Returns the contents of a standard frame after checking the checksum
+    """
+    start = frame.rfind(bytes([START]))
+    stop = frame.find(bytes([STOP]), start + 1)
+    if start < 0 or stop < 0:
+        raise FrameError(f"Incomplete frame {frame.hex()}")
+    data = unstuff(frame[start + 1:stop])
+    if not data:
+        raise FrameError("Empty frame")
+    contents, check = data[:-1], data[-1]
+    if checksum(contents) != check:
+        raise FrameError(f"Bad checksum in frame {frame.hex()}")
+    return contents
+
+def encode_commands(commands):
+    """ Packs a list of commands into frame contents. Each command is either
+        a short command id (0x80 and up) or a (command id, data bytes) pair
+    """
+    buf = bytearray()
+    for command in commands:
+        if isinstance(command, int):
+            buf.append(command)
+        else:
+            command_id, data = command
+            buf.append(command_id)
+            buf.append(len(data))
+            buf += bytes(data)
+    return bytes(buf)
+
+def parse_response(contents):
+    """ Splits response contents into the state name and a dict of
+            command id: response data bytes
+    """
+    state = STATES.get(contents[0] & 0x0F, 'unknown')
+    responses = {}
+    offset = 1
+    while offset < len(contents):
+        if offset + 1 >= len(contents):
+            raise FrameError(f"Truncated response {contents.hex()}")
+        command_id = contents[offset]
+        length = contents[offset + 1]
+        responses[command_id] = contents[offset + 2:offset + 2 + length]
+        offset += 2 + length
+    return state, responses
+
+def parse_measurement(data):
+    """ Converts a 2 byte value + unit response into a float in
+        km/h or % grade
+    """
+    if len(data) < 3:
+        raise FrameError(f"Short measurement {bytes(data).hex()}")
+    value = data[0] | (data[1] << 8)
+    unit = UNITS.get(data[2])
+    if unit is None:
+        raise FrameError(f"Unknown unit {data[2]:#x}")
+    return value * unit[1]
+
+def query(transport, commands):
+    """ Sends all the commands in one frame and returns the parsed
+        (state, responses) from the single response frame
+    """
+    transport.reset_input_buffer()
+    transport.write(encode_frame(encode_commands(commands)))
+    frame = transport.read_until(bytes([STOP]))
+    if not frame:
+        SERIAL_TIMEOUTS.inc(getattr(transport, 'port', None))
+        raise FrameTimeout("Timed out waiting for response")
+    try:
+        return parse_response(decode_frame(frame))
+    except FrameError:
+        SERIAL_ERRORS.inc(getattr(transport, 'port', None))
+        raise
+
+def query_status(transport):
+    """ Batched status poll: status, speed and grade in one round trip
+    """
+    state, responses = query(
+        transport,
+        [CMD_GET_STATUS, CMD_GET_SPEED, CMD_GET_GRADE]
+    )
+    if CMD_GET_SPEED not in responses or CMD_GET_GRADE not in responses:
+        raise FrameError(f"Incomplete status response {responses}")
+    return {
+        'status': state,
+        'speed': parse_measurement(responses[CMD_GET_SPEED]),
+        'grade': parse_measurement(responses[CMD_GET_GRADE]),
+    }
@@ -0,0 +1,271 @@
+import logging
+import threading
+import time
+
+from app.writer import EventWriter
+from app.spool import Spool, SpoolDrainer
+from app.timeseries import TimeSeries
+from app.metrics import DB_ERRORS, DB_LATENCY
+
+log = logging.getLogger(__name__)
+
+# Tables and columns the writes below need, created or added when missing
+# the first time the pool is used. Databases from before devices, capture
+# chunks and sessions are brought up to date in place, when the role is
+# allowed to, see Database.ensure_schema
+SCHEMA = [
+    """
+    create table if not exists events (
+        timestamp timestamptz not null default now(),
+        speed real not null,
+        grade real not null
+    )
+    """,
+    "alter table events add column if not exists device text",
+    "alter table events add column if not exists session text",
+    """
+    create table if not exists event_chunks (
+        id bigserial primary key,
+        start_time timestamptz not null,
+        end_time timestamptz not null,
+        samples integer not null,
+        payload bytea not null,
+        device text
+    )
+    """,
+    """
+    create table if not exists sessions (
+        id text primary key,
+        device text,
+        start_time timestamptz not null,
+        end_time timestamptz,
+        duration double precision not null,
+        distance double precision not null,
+        elevation_gain double precision not null,
+        zones jsonb not null
+    )
+    """,
+    """
+    create table if not exists session_minutes (
+        session text not null,
+        device text,
+        minute timestamptz not null,
+        seconds double precision not null,
+        distance double precision not null,
+        elevation_gain double precision not null,
+        avg_speed double precision not null,
+        max_speed double precision not null,
+        avg_grade double precision not null,
+        primary key ( session, minute )
+    )
+    """,
+    "alter table sessions add column if not exists calories double precision not null default 0",
+]
+
+# The same few statements are run for every row so they're prepared once
+# per connection, rather than building a multi-row insert per batch which
+# the server has to parse every time
+INSERT_EVENT = """
+    insert into events
+    ( timestamp, speed, grade, device, session )
+    values ( %s, %s, %s, %s, %s )
+"""
+
+INSERT_CHUNK = """
+    insert into event_chunks
+    ( start_time, end_time, samples, payload, device )
+    values ( %s, %s, %s, %s, %s )
+"""
+
+UPSERT_SESSION = """
+    insert into sessions
+    ( id, device, start_time, end_time, duration, distance, elevation_gain, zones, calories )
+    values ( %s, %s, %s, %s, %s, %s, %s, %s::jsonb, %s )
+    on conflict ( id ) do update set
+        end_time = excluded.end_time,
+        duration = excluded.duration,
+        distance = excluded.distance,
+        elevation_gain = excluded.elevation_gain,
+        zones = excluded.zones,
+        calories = excluded.calories
+"""
+
+UPSERT_ROLLUP = """
+    insert into session_minutes
+    ( session, device, minute, seconds, distance, elevation_gain, avg_speed, max_speed, avg_grade )
+    values ( %s, %s, %s, %s, %s, %s, %s, %s, %s )
+    on conflict ( session, minute ) do update set
+        seconds = excluded.seconds,
+        distance = excluded.distance,
+        elevation_gain = excluded.elevation_gain,
+        avg_speed = excluded.avg_speed,
+        max_speed = excluded.max_speed,
+        avg_grade = excluded.avg_grade
+"""
+
+class Duration:
+    def __init__(self, start, end=None, metadata=None):
+        self.start = start
+
+class Database:
+    def __init__(self, conninfo:str, spool_path:str='spool.db', replay_rate:float=1000.0,
+                 history_path:str='history.db', history_retention_days=365):
+        # The pool is opened by connect(), away from startup
+        self.conninfo = conninfo
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # Errors worth retrying on another connection, set by connect()
+        self.retryable = ()
+        # Set once SCHEMA has been applied
+        self.schema_ready = False
+
+        # Events go to the local spool first and are drained from there so
+        # nothing is lost while the server is unreachable
+        self.spool = Spool(spool_path)
+        self.writer = EventWriter(self.spool)
+        self.drainer = SpoolDrainer(self.spool, self, max_rate=replay_rate)
+
+        # Per second history kept locally for the history queries
+        self.timeseries = TimeSeries(history_path, retention_days=history_retention_days)
+
+    def connect(self):
+        """ Opens the connection pool if it isn't already. There's one
+            writer, the spool drainer, so the pool only needs a connection
+            for it and one spare. Connections are checked before they're
+            handed out and every statement is prepared on the server the
+            first time a connection runs it
+        """
+        with self.pool_lock:
+            if self.pool is not None:
+                return
+            import psycopg
+            import psycopg_pool
+            self.retryable = (psycopg.OperationalError,)
+            self.pool = psycopg_pool.ConnectionPool(
+                self.conninfo,
+                min_size=1,
+                max_size=2,
+                timeout=10,
+                max_lifetime=1800,
+                max_idle=600,
+                kwargs={'prepare_threshold': 0},
+                check=psycopg_pool.ConnectionPool.check_connection,
+                open=True,
+            )
+
+    def transaction(self, work, *, retry=True):
+        """ Calls `work(conn)` with a pooled connection and commits when it
+            returns. A dropped connection (failover, server restart) is
+            retried once on a fresh one
+        """
+        if self.pool is None:
+            self.connect()
+        tic = time.perf_counter()
+        try:
+            with self.pool.connection() as conn:
+                if not self.schema_ready:
+                    self.ensure_schema(conn)
+                return work(conn)
+        except self.retryable as e:
+            DB_ERRORS.inc()
+            log.warning("DB connection problem: %s", e)
+            if retry:
+                # The broken connection was thrown away when it went back
+                # to the pool, make sure the idle ones are still good too
+                self.pool.check()
+                return self.transaction(work, retry=False)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - tic)
+
+    def ensure_schema(self, conn):
+        """ Applies SCHEMA in its own transaction, so a failed write
+            after it doesn't roll it back. This is best effort: a role
+            that may write to the tables but doesn't own them can't run
+            the DDL even when there's nothing to change, so a failure is
+            logged and the writes go ahead against whatever is there
+        """
+        try:
+            with conn.transaction(), conn.cursor() as cur:
+                for statement in SCHEMA:
+                    # DDL can't be prepared, whatever prepare_threshold says
+                    cur.execute(statement, prepare=False)
+        except self.retryable:
+            # The connection went away, the retry tries again
+            raise
+        except Exception as ex:
+            log.warning("Could not bring the database schema up to date, writing to it as it is: %s", ex)
+        else:
+            log.info("Database schema is up to date")
+        self.schema_ready = True
+
+    def run_query(self, sql, params=None, *, retry=True):
+        def work(conn):
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                if cur.description:
+                    return cur.fetchall()
+                return None
+        return self.transaction(work, retry=retry)
+
+    def inject_event(self, speed:float, grade:float, device:str=None, session:str=None):
+        """ Queues the new event for the background writer. This never
+            touches the network so it's safe to call from the polling loop
+        """
+        log.debug("Saving: %s %skm/h %s%%", device, speed, grade)
+        self.writer.put(speed, grade, device, session)
+
+    def run(self):
+        """ Starts the spool writer and drain threads and the local
+            history's writer
+        """
+        self.writer.run()
+        self.drainer.run()
+        self.timeseries.run()
+
+    def write(self, events=(), chunks=(), rollups=(), sessions=()):
+        """ Writes whatever the spool drainer has, in one transaction. Every
+            row is its own execution of one of the prepared statements, sent
+            together in pipeline mode so the lot costs about one round trip.
+            See inject_events() and friends for the rows
+        """
+        # Only the latest summary of each session in the batch is sent
+        sessions = list({session[0]: session for session in sessions}.values())
+
+        def work(conn):
+            with conn.pipeline(), conn.cursor() as cur:
+                for sql, rows in (
+                    (INSERT_EVENT, events),
+                    (INSERT_CHUNK, chunks),
+                    (UPSERT_ROLLUP, rollups),
+                    (UPSERT_SESSION, sessions),
+                ):
+                    if rows:
+                        cur.executemany(sql, rows)
+        self.transaction(work)
+
+    def inject_events(self, events):
+        """ Injects a batch of (timestamp, speed, grade, device, session)
+            events into `events`
+        """
+        self.write(events=events)
+
+    def inject_chunks(self, chunks):
+        """ Injects a batch of (start, end, samples, payload, device) full
+            resolution capture chunks. See app.capture for the payload format
+        """
+        self.write(chunks=chunks)
+
+    def inject_sessions(self, sessions):
+        """ Upserts a batch of (session, device, start, end, duration,
+            distance, elevation gain, zones, calories) summaries into
+            `sessions`, keyed on the session id
+        """
+        self.write(sessions=sessions)
+
+    def inject_rollups(self, rollups):
+        """ Injects a batch of (session, device, minute, seconds, distance,
+            elevation gain, average speed, max speed, average grade) rows
+            into `session_minutes`. Replaying a minute replaces it
+        """
+        self.write(rollups=rollups)
@@ -0,0 +1,515 @@
+import asyncio
+import functools
+import logging
+import time
+
+from app import gpio_stub
+from app.cadence import PollCadence
+from app.capture import Capture
+from app.programs import hiit_program
+from app.sessions import Session
+from app.dispatcher import CommandDispatcher
+from app.history import History
+from app.publish import STATE
+from app.setpoint import SetpointController
+from app.sim import PtyTreadmill, SimulatedTreadmill
+
+log = logging.getLogger(__name__)
+
+PORTS = {}
+
+class Device:
+    """ One treadmill on one serial port. Holds the treadmill's state and
+        runs its own dispatcher thread and monitor task
+    """
+    def __init__(self, name, port, db, config, scheduler, programs=None,
+                 buttons=None, serial_number=None, debug=False):
+        self.name = name
+        self.port = port
+        self.serial_number = serial_number
+        self.db = db
+        self.scheduler = scheduler
+        self.programs = programs or {}
+        self.config = config
+        self.buttons = buttons
+        self.debug = debug
+
+        # Filled in by connect(), which is slow so it's kept out of here
+        self.simulator = None
+        self.transport = None
+        self.treadmill = None
+
+        # Every serial frame goes through the dispatcher thread. Requests
+        # made before the treadmill is connected wait in its queue
+        self.dispatcher = CommandDispatcher(None, name=name)
+
+        # Speed and grade changes are ramped towards their targets rather
+        # than sent straight to the dispatcher
+        self.setpoints = SetpointController(
+                            self.dispatcher,
+                            speed_rate=config.get('speed_rate', 2.0),
+                            grade_rate=config.get('grade_rate', 1.0),
+                        )
+
+        # Capture mode can be one of
+        # - sampled: about one event a second, only when the values change
+        # - full: every poll, stored as compressed chunks
+        self.capture = None
+        if config.get('capture', 'sampled') == 'full':
+            self.capture = Capture(
+                                self.db.writer,
+                                device=name,
+                                chunk_seconds=config.get('capture_chunk_seconds', 60.0),
+                            )
+
+        # Recent polls for the chart
+        self.history = History(config.get('history_size', 18000))
+
+        # The workout in progress, from go_start until the treadmill stops
+        self.session = None
+        self.session_zones = config.get('zones')
+
+        # How often the monitor polls, which depends on what the treadmill
+        # is doing. The registry sets the in use interval and an offset so
+        # polls across devices are spread out
+        self.cadence = PollCadence(
+                            fast_interval=config.get('poll_fast_interval', 0.1),
+                            idle_interval=config.get('poll_idle_interval', 2.0),
+                            boost_time=config.get('poll_boost_time', 3.0),
+                        )
+        self.poll_offset = 0.0
+
+        # Status can be one of
+        # - idle
+        # - starting
+        # - running
+        # - walking
+        # - manual
+        self.status = None
+        self.display_status = None
+        self.treadmill_status = None
+        self.current_speed = None
+        self.target_speed = None
+        self.current_grade = None
+        self.target_grade = None
+        self.last_update_speed = None
+        self.last_update_grade = None
+        self.last_update_tic = 0.0
+
+        self.start_tic = None
+        self.hiit_end_tic = None
+
+        # Tasks running on the event loop
+        self.tasks = set()
+        self.reconnects = 0
+
+    def connect(self):
+        """ Opens the serial port and sets up the treadmill driver. Blocks,
+            so it's run off the event loop
+        """
+        # The hardware libraries take a while to import on a Pi
+        from app.transport import SerialSupervisor
+        from app.treadmill import Treadmill, BUTTONS, load_gpio
+
+        config = self.config
+        buttons = dict(BUTTONS, **(self.buttons or {}))
+        load_gpio(config.get('simulate', False))
+        port = self.port
+
+        # Hardware free mode: the treadmill is simulated behind a pty and
+        # sees the button presses through the GPIO stub
+        if config.get('simulate'):
+            simulated = SimulatedTreadmill(
+                                acceleration=config.get('simulate_acceleration', 2.0),
+                                grade_rate=config.get('simulate_grade_rate', 1.0),
+                                buttons=buttons,
+                            )
+            gpio_stub.add_listener(simulated.on_gpio)
+            self.simulator = PtyTreadmill(
+                                simulated,
+                                latency=config.get('simulate_latency', 0.02),
+                                jitter=config.get('simulate_jitter', 0.005),
+                            )
+            port = self.simulator.run()
+
+        # Treadmill driver
+        # For the connection to the treadmill, reopened by the supervisor
+        # whenever it fails
+        if port not in PORTS:
+            PORTS[port] = SerialSupervisor(
+                                port,
+                                9600,
+                                timeout=0.2,
+                                serial_number=self.serial_number,
+                                max_timeouts=config.get('serial_max_timeouts', 5),
+                                max_silence=config.get('serial_max_silence', 15.0),
+                                max_backoff=config.get('serial_max_backoff', 30.0),
+                            )
+        self.transport = PORTS[port]
+        if not self.transport.connected:
+            try:
+                self.transport.open()
+            except Exception as ex:
+                # Polls keep retrying through the supervisor
+                log.error("%s: could not open %s: %s", self.name, port, ex)
+                self.transport.fail(ex)
+        self.treadmill = Treadmill(
+                            transport=self.transport,
+                            debug=self.debug,
+                            batched_status=config.get('batched_status', True),
+                            buttons=buttons,
+                        )
+        self.dispatcher.treadmill = self.treadmill
+
+    def start_elapsed(self):
+        self.start_tic = time.time()
+
+    @property
+    def poll_interval(self):
+        return self.cadence.interval
+
+    @poll_interval.setter
+    def poll_interval(self, interval):
+        self.cadence.interval = interval
+
+    def spawn(self, coro):
+        """ Runs the coroutine as a task on the event loop, keeping
+            a reference to it until it's done
+        """
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def press(self, name, button):
+        """ Runs a front panel button press, which sleeps while the pin
+            is held, on a worker thread rather than the event loop
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, button)
+        except Exception as ex:
+            log.error("%s: %s failed: %s", self.name, name, ex)
+
+    def update_status(self, status):
+        self.display_status = status
+        STATE.publish(self.name, status=status)
+
+    async def go_start(self):
+        self.target_speed = None
+        self.target_grade = None
+        self.scheduler.cancel(self)
+        self.setpoints.reset()
+        self.dispatcher.clear_targets()
+        try:
+            await self.dispatcher.acall(functools.partial(
+                self.treadmill.start,
+                self.update_status,
+                step_timeout=self.config.get('start_step_timeout', 2.0),
+                key_gap=self.config.get('start_key_gap', 0.25),
+                retries=self.config.get('start_retries', 2),
+            ))
+        except Exception as ex:
+            log.error("%s: could not start the treadmill: %s", self.name, ex)
+            self.update_status('Start failed')
+            return
+        self.start_elapsed()
+        self.start_session()
+        self.cadence.boost()
+
+    def start_session(self):
+        self.end_session()
+        self.session = Session(
+                            self.name,
+                            self.db.writer,
+                            zones=self.session_zones,
+                            mass=self.config.get('body_mass', 70.0),
+                        )
+        log.info("%s: started session %s", self.name, self.session.id)
+
+    def end_session(self):
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+        session.finish()
+        log.info(
+            "%s: finished session %s, %.2f km, %.0f m climbed, %.0f kcal in %.0f s",
+            self.name, session.id, session.distance, session.elevation_gain,
+            session.calories, session.duration
+        )
+
+    def go_walk(self):
+        self.cadence.boost()
+        self.target_speed = self.current_speed
+        self.status = 'walking'
+        self.setpoints.set_speed(1)
+
+    def go_run(self):
+        self.cadence.boost()
+        self.status = 'running'
+        self.setpoints.set_speed(self.target_speed)
+
+    def do_reset(self):
+        self.cadence.boost()
+        self.end_session()
+        self.scheduler.cancel(self)
+        self.setpoints.reset()
+        self.dispatcher.clear_targets()
+        if self.treadmill:
+            self.spawn(self.press('reset', self.treadmill.reset))
+
+    def go_stop(self):
+        # The reset button is on GPIO so this doesn't need to wait for
+        # the serial port
+        self.cadence.boost()
+        self.end_session()
+        self.scheduler.cancel(self)
+        self.setpoints.reset()
+        self.dispatcher.clear_targets()
+        if self.treadmill:
+            self.spawn(self.press('stop', self.treadmill.stop))
+
+    def go_hiit(self, speed: int=0.0, duration: float=60.0, end_speed: int=1.0):
+        return self.scheduler.start(self, hiit_program(speed, duration, end_speed))
+
+    def go_program(self, name):
+        """ Starts one of the programs loaded from programs.yaml
+        """
+        return self.scheduler.start(self, self.programs[name])
+
+    def stop_program(self):
+        self.scheduler.cancel(self)
+
+    def nudge_speed(self, delta):
+        self.cadence.boost()
+        if self.target_speed is None:
+            self.target_speed = self.current_speed
+        new_speed = self.target_speed + delta
+        if new_speed < 1:
+            new_speed = 1
+        self.target_speed = new_speed
+        self.setpoints.set_speed(new_speed)
+
+    def nudge_grade(self, delta):
+        self.cadence.boost()
+        if self.target_grade is None:
+            self.target_grade = self.current_grade
+        new_grade = self.target_grade + delta
+        if new_grade < 0:
+            new_grade = 0
+        self.target_grade = new_grade
+        self.setpoints.set_grade(new_grade)
+
+    def grade_change(self, value):
+        if value != self.current_grade:
+            self.cadence.boost()
+            self.setpoints.set_grade(value)
+
+    def speed_change(self, value):
+        if value != self.current_speed:
+            self.cadence.boost()
+            self.setpoints.set_speed(value)
+
+    def update_view(self, status):
+        """ Publishes the latest values for the pages to pick up, see
+            StatePublisher. This never waits on a browser
+        """
+        # The elapsed and HIIT clocks run in the browser and only
+        # need to know when they start and stop
+        running = status == 'inuse'
+        STATE.publish(
+            self.name,
+            speed=self.current_speed,
+            grade=self.current_grade,
+            status=status,
+            elapsed_start=self.start_tic if running else None,
+            hiit_end=self.hiit_end_tic if running else None,
+        )
+        # The workout's totals stay up after it ends, until the next one.
+        # Rounded to what's shown so they only change a few times a minute
+        if self.session:
+            STATE.publish(
+                self.name,
+                distance=round(self.session.distance, 2),
+                elevation_gain=round(self.session.elevation_gain),
+                pace=round(self.session.pace * 60) if self.session.pace else None,
+                mets=round(self.session.mets, 1),
+                calories=round(self.session.calories),
+            )
+
+    async def treadmill_monitor(self):
+        # Stagger the first poll so devices don't all hit at once
+        await asyncio.sleep(self.poll_offset)
+
+        while True:
+            try:
+                treadmill_status = None
+                if self.transport and self.transport.reconnects != self.reconnects:
+                    await self.resync()
+                started = time.monotonic()
+                treadmill_status, poll_tic, poll_latency = await self.dispatcher.apoll()
+                self.cadence.observe(poll_latency)
+
+                if treadmill_status:
+                    self.treadmill_status = treadmill_status
+
+                    self.current_speed = round(treadmill_status['speed'], 1)
+                    self.current_grade = round(treadmill_status['grade'], 2)
+
+                    self.setpoints.feedback(self.current_speed, self.current_grade)
+                    self.setpoints.tick()
+                    # The setpoints only ramp as fast as they're ticked
+                    if self.setpoints.moving():
+                        self.cadence.boost()
+
+                    self.history.append(poll_tic, self.current_speed, self.current_grade)
+
+                    if self.capture:
+                        self.capture.add(
+                            treadmill_status['status'],
+                            self.current_speed,
+                            self.current_grade,
+                            poll_latency,
+                            timestamp=poll_tic,
+                        )
+
+                    elif poll_tic - self.last_update_tic >= 1.0:
+                        if self.last_update_speed != self.current_speed \
+                           or self.last_update_grade != self.current_grade:
+                               self.db.inject_event(
+                                    self.current_speed,
+                                    self.current_grade,
+                                    device=self.name,
+                                    session=self.session.id if self.session else None,
+                               )
+                               self.last_update_speed = self.current_speed
+                               self.last_update_grade = self.current_grade
+                               self.last_update_tic = poll_tic
+
+                    status = treadmill_status['status']
+
+                    # Sessions end when the treadmill finishes or drops
+                    # out of use, after having been running
+                    if status == 'inuse':
+                        self.db.timeseries.add(
+                            self.name,
+                            poll_tic,
+                            self.current_speed,
+                            self.current_grade,
+                            self.session.id if self.session else None,
+                        )
+                    else:
+                        self.db.timeseries.pause(self.name)
+
+                    if self.session:
+                        if status == 'inuse':
+                            self.session.add(poll_tic, self.current_speed, self.current_grade)
+                        elif status != 'paused' and self.session.samples:
+                            self.end_session()
+
+                    if status == 'inuse':
+                        if self.status not in ['running', 'walking']:
+                            self.status = 'running'
+
+                    elif status in ['idle','ready']:
+                        self.status = 'idle'
+
+                    elif status in ['finished', 'manual']:
+                        self.status = 'manual'
+
+                    self.display_status = status
+                    self.update_view(status)
+
+                await self.cadence.sleep(self.display_status, started)
+
+            except Exception as ex:
+                if self.transport and not self.transport.connected:
+                    # The supervisor is on it, just show we've lost it
+                    log.warning("%s: %s", self.name, ex)
+                    self.display_status = 'offline'
+                    self.update_view('offline')
+                else:
+                    log.exception("%s: %s <%s>", self.name, ex, treadmill_status)
+                await asyncio.sleep(1)
+
+    async def resync(self):
+        """ The serial port was reopened, get the treadmill and our
+            setpoints back in step
+        """
+        self.reconnects = self.transport.reconnects
+        status = await self.dispatcher.acall(self.treadmill.resync)
+        log.info("%s: resynced, treadmill is %s", self.name, status and status['status'])
+        self.setpoints.resync()
+
+    def run(self):
+        """ Starts the dispatcher thread and the monitor task
+        """
+        self.dispatcher.run()
+        self.spawn(self.treadmill_monitor())
+
+
+class DeviceRegistry:
+    """ All the treadmills driven by this process, keyed by name.
+
+        Polls are spread across the devices: each one gets an evenly spaced
+        offset within the poll interval, and once the devices would exceed
+        `max_polls_per_second` between them the interval is stretched so the
+        combined load stays flat. Each device's cadence then polls slower
+        when idle and faster around changes, never faster than that budget
+        allows.
+    """
+    def __init__(self, poll_interval=0.2, max_polls_per_second=20.0):
+        self.devices = {}
+        self.poll_interval = poll_interval
+        self.max_polls_per_second = max_polls_per_second
+
+    def add(self, device):
+        self.devices[device.name] = device
+        self.schedule()
+        return device
+
+    def schedule(self):
+        count = len(self.devices)
+        floor = count / self.max_polls_per_second
+        interval = max(self.poll_interval, floor)
+        for i, device in enumerate(self.devices.values()):
+            device.poll_interval = interval
+            device.poll_offset = interval * i / count
+            # Fast polling still has to fit in the budget
+            device.cadence.min_interval = floor
+
+    def get(self, name):
+        return self.devices[name]
+
+    @property
+    def primary(self):
+        """ The first device, which gets the control page at / and the
+            keyboard
+        """
+        return next(iter(self.devices.values()))
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
+
+    async def run(self, report):
+        """ Connects every device at the same time, starting each one as
+            soon as it's ready
+        """
+        loop = asyncio.get_running_loop()
+
+        async def start(device):
+            try:
+                await loop.run_in_executor(
+                    None,
+                    report.timed(f"device {device.name}", device.connect)
+                )
+            except Exception as ex:
+                log.error("Could not connect to %s on %s: %s", device.name, device.port, ex)
+                device.update_status('offline')
+                return
+            device.run()
+
+        await asyncio.gather(*[start(device) for device in self])
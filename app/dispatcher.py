@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from app.metrics import POLL_LATENCY, SERIAL_HOLD, SERIAL_WAIT
+
+log = logging.getLogger(__name__)
+
+class CommandDispatcher:
+    """ The only thread that talks to the serial port.
+
+        Speed and grade changes are coalesced: only the latest target for
+        each is kept, so a burst of button presses turns into a single CSAFE
+        frame. Everything else (status polls, the start handshake) is queued
+        as a job with a deadline. The dispatcher always runs whatever has the
+        earliest deadline, and when both a command and a job are overdue it
+        alternates between them so neither can starve the other.
+    """
+    def __init__(self, treadmill, command_deadline=0.05, poll_deadline=0.1, name=None):
+        self.treadmill = treadmill
+        self.name = name
+        self.command_deadline = command_deadline
+        self.poll_deadline = poll_deadline
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.targets = {}
+        self.sequence = itertools.count()
+        self.last_kind = None
+
+    def submit(self, fn, *args, deadline=None, kind='job'):
+        """ Queues fn(*args) to run on the dispatcher thread and returns
+            a Future for its result
+        """
+        queued = time.monotonic()
+        if deadline is None:
+            deadline = queued
+        future = Future()
+        with self.condition:
+            heapq.heappush(self.jobs, (deadline, next(self.sequence), fn, args, future, queued, kind))
+            self.condition.notify()
+        return future
+
+    def call(self, fn, *args):
+        """ Runs fn(*args) on the dispatcher thread and waits for the result
+        """
+        return self.submit(fn, *args).result()
+
+    async def acall(self, fn, *args):
+        """ Awaitable version of call() for use on the event loop
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def submit_poll(self):
+        """ Queues a status poll. The Future's result is (status, poll start
+            time, latency in seconds) where latency only covers the serial I/O
+        """
+        return self.submit(
+                    self.timed_status,
+                    deadline=time.monotonic() + self.poll_deadline,
+                    kind='poll',
+                )
+
+    def poll(self):
+        """ Polls the treadmill status, see submit_poll()
+        """
+        return self.submit_poll().result()
+
+    async def apoll(self):
+        """ Awaitable version of poll() for use on the event loop
+        """
+        return await asyncio.wrap_future(self.submit_poll())
+
+    def timed_status(self):
+        tic = time.time()
+        status = self.treadmill.status()
+        latency = time.time() - tic
+        POLL_LATENCY.observe(latency, self.name)
+        return status, tic, latency
+
+    def set_target(self, name, value):
+        with self.condition:
+            if name in self.targets:
+                _, deadline, queued = self.targets[name]
+            else:
+                queued = time.monotonic()
+                deadline = queued + self.command_deadline
+            self.targets[name] = (value, deadline, queued)
+            self.condition.notify()
+
+    def set_speed(self, value):
+        """ Requests a new speed. Never blocks, replaces any pending speed
+        """
+        self.set_target('speed', value)
+
+    def set_grade(self, value):
+        """ Requests a new grade. Never blocks, replaces any pending grade
+        """
+        self.set_target('grade', value)
+
+    def clear_targets(self):
+        """ Forgets any speed or grade changes that haven't been sent yet
+        """
+        with self.condition:
+            self.targets.clear()
+
+    def next_task(self):
+        """ Picks what to run next. Must be called holding the condition
+        """
+        command = None
+        if self.targets:
+            name = min(self.targets, key=lambda name: self.targets[name][1])
+            command = (self.targets[name][1], name)
+        job = self.jobs[0] if self.jobs else None
+
+        if command and job:
+            now = time.monotonic()
+            if command[0] <= now and job[0] <= now:
+                use_command = self.last_kind != 'command'
+            else:
+                use_command = command[0] <= job[0]
+        else:
+            use_command = command is not None
+
+        if use_command:
+            self.last_kind = 'command'
+            name = command[1]
+            value, _, queued = self.targets.pop(name)
+            if name == 'speed':
+                return self.treadmill.set_speed, (value,), None, queued, name
+            return self.treadmill.set_grade, (value,), None, queued, name
+
+        self.last_kind = 'job'
+        _, _, fn, args, future, queued, kind = heapq.heappop(self.jobs)
+        return fn, args, future, queued, kind
+
+    def dispatch_loop(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.targets:
+                    self.condition.wait()
+                fn, args, future, queued, kind = self.next_task()
+
+            if future is not None and not future.set_running_or_notify_cancel():
+                continue
+            tic = time.monotonic()
+            SERIAL_WAIT.observe(tic - queued, self.name, kind)
+            try:
+                result = fn(*args)
+            except Exception as ex:
+                SERIAL_HOLD.observe(time.monotonic() - tic, self.name, kind)
+                if future is None:
+                    log.error("Command failed: %s", ex)
+                else:
+                    future.set_exception(ex)
+                continue
+            SERIAL_HOLD.observe(time.monotonic() - tic, self.name, kind)
+            if future is not None:
+                future.set_result(result)
+
+    def run(self):
+        """ Starts the dispatcher thread
+        """
+        self.dispatch_thread = threading.Thread(target=self.dispatch_loop)
+        self.dispatch_thread.daemon = True
+        self.dispatch_thread.start()
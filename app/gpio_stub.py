@@ -0,0 +1,45 @@
+""" Stand-in for RPi.GPIO when running off the Pi. Pin levels are kept in
+    memory and every output change is passed to the listeners, which is how
+    the simulated treadmill sees the front panel buttons being pressed.
+"""
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+HIGH = True
+LOW = False
+
+PINS = {}
+LISTENERS = []
+
+def add_listener(fn):
+    """ `fn(pin, value)` is called whenever an output pin changes
+    """
+    LISTENERS.append(fn)
+
+def remove_listener(fn):
+    LISTENERS.remove(fn)
+
+def setwarnings(flag):
+    pass
+
+def setmode(mode):
+    pass
+
+def setup(pin, direction, initial=LOW):
+    PINS[pin] = bool(initial)
+
+def output(pin, value):
+    value = bool(value)
+    changed = PINS.get(pin) != value
+    PINS[pin] = value
+    if changed:
+        for listener in list(LISTENERS):
+            listener(pin, value)
+
+def input(pin):
+    return PINS.get(pin, False)
+
+def cleanup():
+    PINS.clear()
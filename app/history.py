@@ -0,0 +1,99 @@
+import threading
+
+from array import array
+
+class History:
+    """ The last `size` polls of speed and grade in fixed size arrays used as
+        a ring buffer, so a long session never grows memory. Every sample
+        gets a sequence number, which lets a reader ask for only what was
+        added since it last looked.
+    """
+    def __init__(self, size=18000):
+        self.size = size
+        self.timestamps = array('d', bytes(8 * size))
+        self.speeds = array('d', bytes(8 * size))
+        self.grades = array('d', bytes(8 * size))
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp:float, speed:float, grade:float):
+        with self.lock:
+            i = self.count % self.size
+            self.timestamps[i] = timestamp
+            self.speeds[i] = speed
+            self.grades[i] = grade
+            self.count += 1
+
+    def since(self, seq:int=0):
+        """ Returns (latest sequence number, [(timestamp, speed, grade)])
+            for every sample after `seq` that's still in the buffer
+        """
+        with self.lock:
+            end = self.count
+            start = max(seq, end - self.size)
+            return end, [
+                (self.timestamps[j], self.speeds[j], self.grades[j])
+                for j in (i % self.size for i in range(start, end))
+            ]
+
+    def window(self, seconds:float):
+        """ Returns (latest sequence number, samples) for the last `seconds`
+            before the newest sample
+        """
+        with self.lock:
+            end = self.count
+            oldest = max(0, end - self.size)
+            if end == oldest:
+                return end, []
+            cutoff = self.timestamps[(end - 1) % self.size] - seconds
+            # Timestamps only go up so bisect back from the newest
+            lo, hi = oldest, end - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.timestamps[mid % self.size] < cutoff:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return end, [
+                (self.timestamps[j], self.speeds[j], self.grades[j])
+                for j in (i % self.size for i in range(lo, end))
+            ]
+
+def lttb(points, threshold:int):
+    """ Largest-Triangle-Three-Buckets: picks `threshold` of the (x, y)
+        points that keep the shape of the line, always including the
+        first and last
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket, the third corner of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        count = next_end - next_start
+        avg_x = sum(point[0] for point in points[next_start:next_end]) / count
+        avg_y = sum(point[1] for point in points[next_start:next_end]) / count
+
+        # The point in this bucket making the biggest triangle with the
+        # last point picked and that average
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = points[a]
+        best_area = -1.0
+        best = start
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        sampled.append(points[best])
+        a = best
+
+    sampled.append(points[-1])
+    return sampled
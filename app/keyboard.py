@@ -1,76 +1,146 @@
-import evdev
-from evdev import InputDevice, categorize, ecodes
+import asyncio
+import logging
 
-DEVICE_NAME = 'HAOBO Technology USB Composite Device Keyboard'
+from app.actions import NUDGES
+
+log = logging.getLogger(__name__)
+
+class NudgeBatcher:
+    """ Adds up speed and grade nudges for `window` seconds and then makes
+        them one target change each, so tapping or holding a key turns into
+        a few setpoint changes rather than one per key event
+    """
+    def __init__(self, apply, window=0.15):
+        self.apply = apply
+        self.window = window
+        self.pending = {}
+        self.handle = None
+
+    def add(self, name, delta):
+        self.pending[name] = self.pending.get(name, 0.0) + delta
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self.handle = None
+        pending = self.pending
+        self.pending = {}
+        for name, delta in pending.items():
+            if abs(delta) > 1e-9:
+                try:
+                    self.apply(name, delta)
+                except Exception as ex:
+                    log.error("Could not nudge %s by %s: %s", name, delta, ex)
+
+
+def hold_factor(held, start=0.5, rate=2.0, maximum=3.0):
+    """ How much bigger each repeat's step gets the longer a key is held:
+        1x for the first `start` seconds then growing by `rate` per second
+        up to `maximum`
+    """
+    if held <= start:
+        return 1.0
+    return min(1.0 + (held - start) * rate, maximum)
 
 class Keyboard:
-    def __init__(self, service):
+    def __init__(self, service, bindings, batch_window=0.15, repeat_interval=0.1):
         self.device = None
         self.service = service
+        self.bindings = bindings
+        self.batcher = NudgeBatcher(self.nudge, batch_window)
+        # Scancode: (action, value), rebuilt whenever the bindings change
+        self.keymap = {}
+        bindings.on_reload(self.load_keymap)
+        # Auto repeat comes in at about 30 a second, only one repeat every
+        # `repeat_interval` seconds counts as a nudge
+        self.repeat_interval = repeat_interval
+        # Keys held down: [when pressed, when last counted]
+        self.held = {}
 
     def find_keyboard(self):
+        # evdev is imported here rather than at the top since it's slow
+        # to load and this runs off the event loop
+        import evdev
         devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
         for device in devices:
-            print(f"- {device.name}")
-            if device.name != DEVICE_NAME:
+            log.debug("Found input device %s", device.name)
+            if device.name != self.bindings.keyboard_name:
                 continue
             return device.path
 
-    def keyboard_monitor(self):
-        device_path = self.find_keyboard()
+    def load_keymap(self):
+        """ Turns the key names in the bindings into scancodes
+        """
+        if self.device is None:
+            return
+        from evdev import ecodes
+        keymap = {}
+        for name, binding in self.bindings.keys.items():
+            scancode = ecodes.ecodes.get(name)
+            if scancode is None:
+                log.warning("Unknown key %s in the bindings", name)
+                continue
+            keymap[scancode] = (binding['action'], binding.get('value'))
+        self.keymap = keymap
+
+    async def keyboard_monitor(self, device_path=None):
+        # Enumerating the input devices blocks so keep it off the event loop
+        if device_path is None:
+            device_path = await asyncio.get_running_loop().run_in_executor(None, self.find_keyboard)
+        if device_path is None:
+            log.warning("Keyboard '%s' not found", self.bindings.keyboard_name)
+            return
+
+        # Already loaded by find_keyboard()
+        from evdev import InputDevice, categorize, ecodes
         self.device = InputDevice(device_path)
+        self.load_keymap()
 
         # Exclusive use of the device
         self.device.grab()
 
-        for event in self.device.read_loop():
-            if event.type == ecodes.EV_KEY:
-                key_event = categorize(event)
-                if key_event.keystate == key_event.key_down:
-                    print(f"{key_event.keycode} pressed")
-                    if key_event.scancode == evdev.ecodes.KEY_DOWN:
-                        self.service.nudge_grade(-0.5)
-                    elif key_event.scancode == evdev.ecodes.KEY_UP:
-                        self.service.nudge_grade(0.5)
-                    elif key_event.scancode == evdev.ecodes.KEY_LEFT:
-                        self.service.nudge_speed(-0.2)
-                    elif key_event.scancode == evdev.ecodes.KEY_RIGHT:
-                        self.service.nudge_speed(0.2)
-                    elif key_event.scancode == evdev.ecodes.KEY_SELECT:
-                        status = self.service.status
-                        if status == 'idle':
-                            self.service.go_start()
-                        elif status == 'running':
-                            print("Move to walking")
-                            self.service.go_walk()
-                        elif status == 'walking':
-                            print("Move to running")
-                            self.service.go_run()
-
-                    elif key_event.scancode == evdev.ecodes.KEY_PLAYPAUSE:
-                        print(f"!!!!! MEDIA PLAYPLAUSE")
-                    elif key_event.scancode == evdev.ecodes.KEY_POWER:
-                        print(f"!!!!! POWER")
-
-                    elif key_event.scancode == evdev.ecodes.KEY_PREVIOUSSONG:
-                        print(f"!!!!! PREVIOUSSONG")
-                    elif key_event.scancode == evdev.ecodes.KEY_NEXTSONG:
-                        print(f"!!!!! NEXTSONG")
-
-
-                    elif key_event.scancode == evdev.ecodes.KEY_VOLUMEUP:
-                        print(f"!!!!! VOLUMEUP")
-                    elif key_event.scancode == evdev.ecodes.KEY_VOLUMEDOWN:
-                        print(f"!!!!! VOLUMEDOWN")
-
-                    elif key_event.scancode == evdev.ecodes.KEY_HOMEPAGE:
-                        self.service.do_reset()
-
-
-    def run(self):
-        """ Executes the thread that will monitor the keyboard and
-            pass on relevant events to the 
+        async for event in self.device.async_read_loop():
+            if event.type != ecodes.EV_KEY:
+                continue
+            key_event = categorize(event)
+            scancode = key_event.scancode
+            binding = self.keymap.get(scancode)
+
+            # Nudges repeat while the key is held, with bigger steps the
+            # longer it's down. They only add to the batcher here, which
+            # changes the setpoints once the burst is over
+            if key_event.keystate == key_event.key_up:
+                self.held.pop(scancode, None)
+                continue
+            if key_event.keystate == key_event.key_hold:
+                held = self.held.get(scancode)
+                now = event.timestamp()
+                if binding and binding[0] in NUDGES and held and now - held[1] >= self.repeat_interval:
+                    held[1] = now
+                    action, value = binding
+                    self.batcher.add(action, float(value) * hold_factor(now - held[0]))
+                continue
+
+            if key_event.keystate != key_event.key_down:
+                continue
+            log.debug("%s pressed", key_event.keycode)
+            self.held[scancode] = [event.timestamp(), event.timestamp()]
+            if binding is None:
+                continue
+            action, value = binding
+            if action in NUDGES:
+                self.batcher.add(action, float(value))
+                continue
+            try:
+                self.bindings.run(self.service, action, value)
+            except Exception as ex:
+                log.error("Key %s: %s failed: %s", key_event.keycode, action, ex)
+
+    def nudge(self, action, delta):
+        self.bindings.run(self.service, action, delta)
+
+    def run(self, device_path=None):
+        """ Starts the task that will monitor the keyboard and
+            pass on relevant events to the service
         """
-        self.keyboard_monitor_thread = threading.Thread(target=self.keyboard_monitor)
-        self.keyboard_monitor_thread.daemon = True
-        self.keyboard_monitor_thread.start()
+        return self.service.spawn(self.keyboard_monitor(device_path))
@@ -0,0 +1,114 @@
+import collections
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+class RepeatFilter(logging.Filter):
+    """ Lets the first of a run of identical messages through and swallows
+        the rest for `window` seconds. The next one after that carries a
+        count of how many were dropped.
+    """
+    def __init__(self, window=10.0):
+        super().__init__()
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen = {}
+
+    def filter(self, record):
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self.lock:
+            first, suppressed = self.seen.get(key, (None, 0))
+            if first is not None and now - first < self.window:
+                self.seen[key] = (first, suppressed + 1)
+                return False
+            self.seen[key] = (now, 0)
+            if len(self.seen) > 1000:
+                # Forget anything that's been quiet for a while
+                self.seen = {
+                    key: value for key, value in self.seen.items()
+                    if now - value[0] < self.window
+                }
+        if suppressed:
+            record.msg = f"{message} (repeated {suppressed} more times)"
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Never blocks the caller: when the writer thread has fallen behind
+        the record is dropped and counted instead
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RecentEvents(logging.Handler):
+    """ Keeps the last `size` records for the UI's log page. Each entry
+        gets a sequence number so the page can ask for just the new ones
+    """
+    def __init__(self, size=500):
+        super().__init__()
+        self.records = collections.deque(maxlen=size)
+        self.sequence = itertools.count(1)
+        self.records_lock = threading.Lock()
+
+    def emit(self, record):
+        entry = {
+            'seq': next(self.sequence),
+            'time': record.created,
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        with self.records_lock:
+            self.records.append(entry)
+
+    def since(self, seq=0):
+        """ Returns the entries newer than `seq`, oldest first
+        """
+        with self.records_lock:
+            return [entry for entry in self.records if entry['seq'] > seq]
+
+RECENT = RecentEvents()
+
+def setup_logging(level='INFO', ring_size=500, repeat_window=10.0, max_queue=10000):
+    """ Sends everything logged under the `app` logger through a queue to a
+        writer thread, so nothing on the serial, GPIO or event loop paths
+        ever waits for stdout. Returns the listener
+    """
+    RECENT.records = collections.deque(RECENT.records, maxlen=ring_size)
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(
+                    queue.Queue(maxsize=max_queue),
+                    stream,
+                    RECENT,
+                    respect_handler_level=True,
+                )
+
+    handler = DroppingQueueHandler(listener.queue)
+    handler.addFilter(RepeatFilter(repeat_window))
+
+    logger = logging.getLogger('app')
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.handlers = [handler]
+    logger.propagate = False
+
+    listener.start()
+    return listener
@@ -0,0 +1,160 @@
+import bisect
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Latencies on this box range from a few hundred microseconds (local
+# spool) to a couple of seconds (start handshake, database failover)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.metrics.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = self.header()
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def expose(self):
+        lines = self.header()
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{self.name}_bucket{format_labels(self.labels, labels, ('le', bound))} {cumulative}"
+                    )
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labels, labels, ('le', '+Inf'))} {count}"
+                )
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """ Holds the metrics and renders them in the Prometheus text format.
+        While disabled every observation returns straight away, so leaving
+        the instrumentation in the hot paths costs next to nothing.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = []
+        self.collectors = []
+
+    def on_collect(self, fn):
+        """ `fn()` runs before every scrape, for gauges that are cheaper to
+            read when asked for than to keep up to date
+        """
+        self.collectors.append(fn)
+
+    def expose(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as ex:
+                log.error("Metrics collector failed: %s", ex)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+METRICS = Registry()
+
+POLL_LATENCY = Histogram(METRICS, 'treadmill_poll_latency_seconds',
+                         'Time taken by one status poll on the serial link', ('device',))
+SERIAL_WAIT = Histogram(METRICS, 'treadmill_serial_wait_seconds',
+                        'Time a serial request waited for the dispatcher', ('device', 'kind'))
+SERIAL_HOLD = Histogram(METRICS, 'treadmill_serial_hold_seconds',
+                        'Time a serial request held the dispatcher', ('device', 'kind'))
+SERIAL_QUEUE = Gauge(METRICS, 'treadmill_serial_queue_depth',
+                     'Requests waiting for the dispatcher', ('device',))
+SERIAL_ERRORS = Counter(METRICS, 'treadmill_serial_errors_total',
+                        'Bad or unparseable CSAFE frames', ('port',))
+SERIAL_TIMEOUTS = Counter(METRICS, 'treadmill_serial_timeouts_total',
+                          'CSAFE requests that got no response', ('port',))
+START_STEP = Histogram(METRICS, 'treadmill_start_step_seconds',
+                       'Time taken by each step of starting the treadmill', ('step',))
+DB_LATENCY = Histogram(METRICS, 'treadmill_db_query_seconds',
+                       'Time taken by a postgres query')
+DB_ERRORS = Counter(METRICS, 'treadmill_db_errors_total',
+                    'Postgres queries that failed')
+WRITER_QUEUE = Gauge(METRICS, 'treadmill_writer_queue_depth',
+                     'Events waiting to be written to the spool')
+SPOOL_BACKLOG = Gauge(METRICS, 'treadmill_spool_backlog',
+                      'Events in the spool waiting for postgres')
+UI_FLUSH = Histogram(METRICS, 'treadmill_ui_flush_seconds',
+                     'Time taken to push changed fields to the UI')
+UI_UPDATES = Counter(METRICS, 'treadmill_ui_updates_total',
+                     'Fields pushed to the UI', ('field',))
+UI_SKIPPED = Counter(METRICS, 'treadmill_ui_versions_skipped_total',
+                     'State versions published that a page never rendered', ('device',))
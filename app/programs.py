@@ -0,0 +1,219 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import yaml
+
+log = logging.getLogger(__name__)
+
+class Step:
+    """ One setpoint change within a program. `offset` is seconds from the
+        start of the program, `segment_end` when the segment it belongs to
+        finishes (that's what the countdown on the UI shows)
+    """
+    def __init__(self, offset, speed=None, grade=None, segment_end=None):
+        self.offset = offset
+        self.speed = speed
+        self.grade = grade
+        self.segment_end = segment_end
+
+def ramp_values(start, end, steps):
+    if steps <= 1:
+        return [end]
+    return [start + (end - start) * i / (steps - 1) for i in range(steps)]
+
+def segment_range(segment, field, kind):
+    """ The [start, end] of `field` in a ramp or pyramid segment, None if
+        the segment doesn't change it
+    """
+    if field not in segment:
+        return None
+    values = segment[field]
+    if not isinstance(values, (list, tuple)) or len(values) != 2:
+        raise ValueError(f"a {kind} segment's {field} has to be [start, end], not {values!r}")
+    return values
+
+def expand_segment(segment, offset):
+    """ Turns one segment from the program definition into Steps. Returns
+        the steps and the segment's duration
+
+        Segments can be one of
+        - interval: hold `speed`/`grade` for `duration` seconds (or forever
+          if it's the last segment without a duration)
+        - ramp: move `speed`/`grade` from [start, end] over `duration`
+          seconds in `steps` even steps
+        - pyramid: climb `speed`/`grade` from [start, peak] in `steps`
+          steps of `step_duration` seconds, then back down again
+    """
+    kind = segment.get('type', 'interval')
+    duration = float(segment.get('duration', 0))
+
+    if kind == 'interval':
+        return [Step(
+                    offset,
+                    speed=segment.get('speed'),
+                    grade=segment.get('grade'),
+                    segment_end=offset + duration if duration else None,
+                )], duration
+
+    if kind == 'ramp':
+        steps = int(segment.get('steps', max(1, duration // 10)))
+        speed_range = segment_range(segment, 'speed', kind)
+        grade_range = segment_range(segment, 'grade', kind)
+        speeds = ramp_values(*speed_range, steps) if speed_range else [None] * steps
+        grades = ramp_values(*grade_range, steps) if grade_range else [None] * steps
+        step_duration = duration / steps
+        return [
+            Step(offset + i * step_duration, speed=speed, grade=grade, segment_end=offset + duration)
+            for i, (speed, grade) in enumerate(zip(speeds, grades))
+        ], duration
+
+    if kind == 'pyramid':
+        steps = int(segment.get('steps', 3))
+        step_duration = float(segment['step_duration'])
+        speed_range = segment_range(segment, 'speed', kind)
+        grade_range = segment_range(segment, 'grade', kind)
+        speeds = ramp_values(*speed_range, steps) if speed_range else [None] * steps
+        grades = ramp_values(*grade_range, steps) if grade_range else [None] * steps
+        # Up to the peak then back down, without repeating the peak
+        levels = list(zip(speeds, grades))
+        levels = levels + levels[-2::-1]
+        duration = step_duration * len(levels)
+        return [
+            Step(offset + i * step_duration, speed=speed, grade=grade, segment_end=offset + duration)
+            for i, (speed, grade) in enumerate(levels)
+        ], duration
+
+    raise ValueError(f"Unknown segment type '{kind}'")
+
+class Program:
+    """ A named list of segments, expanded into timed Steps up front
+    """
+    def __init__(self, name, segments):
+        self.name = name
+        self.steps = []
+        offset = 0.0
+        for segment in segments:
+            try:
+                steps, duration = expand_segment(segment, offset)
+            except (ValueError, KeyError, TypeError) as ex:
+                raise ValueError(f"Program '{name}': {ex}") from ex
+            self.steps.extend(steps)
+            offset += duration
+        self.duration = offset
+
+def load_programs(path):
+    """ Loads the programs from a YAML file shaped like programs.yaml.template
+    """
+    with open(path) as f:
+        definitions = yaml.safe_load(f) or {}
+    return {
+        name: Program(name, segments)
+        for name, segments in (definitions.get('programs') or {}).items()
+    }
+
+def hiit_program(speed=8.0, duration=60.0, end_speed=1.0):
+    """ The single interval the HIIT button has always done
+    """
+    return Program('hiit', [
+        {'type': 'interval', 'speed': speed, 'duration': duration},
+        {'type': 'interval', 'speed': max(end_speed, 1.0)},
+    ])
+
+
+class ProgramRun:
+    def __init__(self, device, program):
+        self.device = device
+        self.program = program
+        self.cancelled = False
+        self.done = False
+
+
+class ProgramScheduler:
+    """ Runs every program on every device from one thread. All the steps of
+        all the running programs sit in a single heap ordered by when they're
+        due; cancelling a run just flags it and its steps get skipped as they
+        come up. Steps go to the device's setpoint controller like any other
+        speed or grade change.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = itertools.count()
+        self.runs = {}
+
+    def start(self, device, program):
+        """ Starts `program` on `device`, replacing whatever it was running
+        """
+        run = ProgramRun(device, program)
+        start = time.monotonic()
+        with self.condition:
+            previous = self.runs.get(device.name)
+            if previous:
+                previous.cancelled = True
+            self.runs[device.name] = run
+            for step in program.steps:
+                heapq.heappush(self.heap, (start + step.offset, next(self.sequence), run, step))
+            heapq.heappush(self.heap, (start + program.duration, next(self.sequence), run, None))
+            self.condition.notify()
+        # The monitor polls fast around every step
+        device.cadence.expect([start + step.offset for step in program.steps] + [start + program.duration])
+        return run
+
+    def cancel(self, device):
+        """ Stops whatever program is running on `device`
+        """
+        with self.condition:
+            run = self.runs.pop(device.name, None)
+            if run:
+                run.cancelled = True
+        device.hiit_end_tic = None
+        device.cadence.expect([])
+
+    def apply(self, run, step):
+        device = run.device
+        device.cadence.boost()
+        if step is None:
+            run.done = True
+            device.hiit_end_tic = None
+            return
+        if step.speed is not None:
+            device.target_speed = step.speed
+            device.setpoints.set_speed(step.speed)
+        if step.grade is not None:
+            device.target_grade = step.grade
+            device.setpoints.set_grade(step.grade)
+        if step.segment_end is None:
+            device.hiit_end_tic = None
+        else:
+            device.hiit_end_tic = time.time() + step.segment_end - step.offset
+
+    def schedule_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    due, _, run, step = self.heap[0]
+                    wait = due - time.monotonic()
+                    if run.cancelled or wait <= 0:
+                        heapq.heappop(self.heap)
+                        break
+                    self.condition.wait(wait)
+                if run.cancelled:
+                    continue
+                if step is None and self.runs.get(run.device.name) is run:
+                    del self.runs[run.device.name]
+            try:
+                self.apply(run, step)
+            except Exception as ex:
+                log.error("Program %s on %s: %s", run.program.name, run.device.name, ex)
+
+    def run(self):
+        """ Starts the scheduler thread
+        """
+        self.schedule_thread = threading.Thread(target=self.schedule_loop)
+        self.schedule_thread.daemon = True
+        self.schedule_thread.start()
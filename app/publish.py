@@ -0,0 +1,73 @@
+import threading
+
+from app.metrics import UI_SKIPPED
+
+MISSING = object()
+
+class StatePublisher:
+    """ The latest state of every treadmill, as one snapshot dict each.
+        The monitor publishes into it and never waits on a browser: a
+        publish swaps in a new dict and bumps the version, that's all.
+        Every browser's page reads it through its own Subscription on its
+        own timer and only renders the newest snapshot, so a page is rate
+        limited to its timer however often the monitor publishes. A page
+        whose browser still has updates waiting in NiceGUI's outbox skips
+        its turn, see app.ui.render_snapshot, so a slow browser drops the
+        stale versions and gets the newest one once it has caught up.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.versions = {}
+
+    def publish(self, device, **fields):
+        """ Merges `fields` into the device's snapshot. Snapshots are never
+            changed once published, so readers can hold on to them
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(device, {})
+            changed = {
+                field: value for field, value in fields.items()
+                if snapshot.get(field, MISSING) != value
+            }
+            if not changed:
+                return
+            self.snapshots[device] = {**snapshot, **changed}
+            self.versions[device] = self.versions.get(device, 0) + 1
+
+    def latest(self, device):
+        """ Returns (version, snapshot) for the device
+        """
+        with self.lock:
+            return self.versions.get(device, 0), self.snapshots.get(device, {})
+
+    def subscribe(self, device):
+        return Subscription(self, device)
+
+
+class Subscription:
+    """ One page's view of one device's snapshots
+    """
+    def __init__(self, publisher, device):
+        self.publisher = publisher
+        self.device = device
+        self.version = -1
+
+    def poll(self):
+        """ Returns the newest snapshot if it changed since the last poll,
+            otherwise None
+        """
+        version, snapshot = self.publisher.latest(self.device)
+        if version == self.version:
+            return None
+        if self.version >= 0 and version > self.version + 1:
+            UI_SKIPPED.inc(self.device, amount=version - self.version - 1)
+        self.version = version
+        return snapshot
+
+    def reset(self):
+        """ The next poll returns the snapshot even if it hasn't changed
+        """
+        self.version = -1
+
+STATE = StatePublisher()
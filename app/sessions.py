@@ -0,0 +1,168 @@
+import json
+import time
+import uuid
+
+# Speed zones in km/h: name and the speed the zone starts at
+ZONES = {
+    'walk': 0.0,
+    'jog': 6.0,
+    'run': 9.0,
+}
+
+# Above this speed in km/h the ACSM running equation is used rather than
+# the walking one
+RUNNING_SPEED = 8.0
+
+# Resting oxygen uptake in ml/kg/min, one MET
+RESTING_VO2 = 3.5
+
+def acsm_vo2(speed, grade):
+    """ Oxygen uptake in ml/kg/min for `speed` km/h up `grade` %, from
+        the ACSM walking and running equations. Downhill is taken as flat,
+        the equations don't cover it
+    """
+    if speed <= 0:
+        return RESTING_VO2
+    metres_per_minute = speed * 1000 / 60
+    slope = max(grade, 0.0) / 100
+    if speed < RUNNING_SPEED:
+        return 0.1 * metres_per_minute + 1.8 * metres_per_minute * slope + RESTING_VO2
+    return 0.2 * metres_per_minute + 0.9 * metres_per_minute * slope + RESTING_VO2
+
+def pace(speed):
+    """ Minutes per km at `speed` km/h, None when standing still
+    """
+    if speed <= 0:
+        return None
+    return 60.0 / speed
+
+class Rollup:
+    """ Totals for one minute of a session
+    """
+    def __init__(self, minute):
+        self.minute = minute
+        self.seconds = 0.0
+        self.distance = 0.0
+        self.elevation_gain = 0.0
+        self.speed_seconds = 0.0
+        self.grade_seconds = 0.0
+        self.max_speed = 0.0
+
+    def add(self, dt, speed, grade, distance, climb):
+        self.seconds += dt
+        self.distance += distance
+        self.elevation_gain += climb
+        self.speed_seconds += speed * dt
+        self.grade_seconds += grade * dt
+        self.max_speed = max(self.max_speed, speed)
+
+    def row(self, session):
+        seconds = self.seconds or 1.0
+        return (
+            session.id,
+            session.device,
+            self.minute,
+            self.seconds,
+            self.distance,
+            self.elevation_gain,
+            self.speed_seconds / seconds,
+            self.max_speed,
+            self.grade_seconds / seconds,
+        )
+
+
+class Session:
+    """ One workout, from go_start until the treadmill is stopped or
+        finishes. The summary and the per-minute rollups are kept up to date
+        as the polls come in, each sample costing a handful of additions.
+        Between two polls the treadmill is taken to hold the earlier poll's
+        speed and grade, and gaps longer than `max_gap` seconds (a stalled
+        serial port) only count for `max_gap`. Distances are in km and
+        elevation gain in metres. Calories are estimated from the ACSM
+        equations for someone weighing `mass` kg, at about 5 kcal per
+        litre of oxygen.
+    """
+    def __init__(self, device, writer=None, zones=None, start=None, max_gap=5.0, mass=70.0):
+        self.id = str(uuid.uuid4())
+        self.device = device
+        self.writer = writer
+        self.max_gap = max_gap
+        self.mass = mass
+        self.zones = sorted((zones or ZONES).items(), key=lambda zone: zone[1])
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.duration = 0.0
+        self.distance = 0.0
+        self.elevation_gain = 0.0
+        self.calories = 0.0
+        # For the latest poll
+        self.mets = 1.0
+        self.pace = None
+        self.zone_seconds = {name: 0.0 for name, _ in self.zones}
+        self.samples = 0
+        self.last = None
+        self.rollup = None
+
+    def zone(self, speed):
+        name = self.zones[0][0]
+        for zone, lower in self.zones:
+            if speed >= lower:
+                name = zone
+        return name
+
+    def add(self, timestamp, speed, grade):
+        """ Takes one poll: `timestamp` in seconds since the epoch, `speed`
+            in km/h and `grade` in %
+        """
+        self.samples += 1
+        self.mets = acsm_vo2(speed, grade) / RESTING_VO2
+        self.pace = pace(speed)
+        if self.last is not None:
+            last_timestamp, last_speed, last_grade = self.last
+            dt = min(max(timestamp - last_timestamp, 0.0), self.max_gap)
+            distance = last_speed * dt / 3600
+            climb = distance * 1000 * last_grade / 100 if last_grade > 0 else 0.0
+
+            self.duration += dt
+            self.distance += distance
+            self.elevation_gain += climb
+            self.calories += acsm_vo2(last_speed, last_grade) * self.mass * dt / 12000
+            self.zone_seconds[self.zone(last_speed)] += dt
+
+            minute = last_timestamp - last_timestamp % 60
+            if self.rollup is not None and self.rollup.minute != minute:
+                self.flush_rollup()
+            if self.rollup is None:
+                self.rollup = Rollup(minute)
+            self.rollup.add(dt, last_speed, last_grade, distance, climb)
+        self.last = (timestamp, speed, grade)
+
+    def flush_rollup(self):
+        """ Queues the minute collected so far along with the summary up to
+            it, so a crash loses at most a minute
+        """
+        if self.rollup is None:
+            return
+        if self.writer:
+            self.writer.put_rollup(self.rollup.row(self))
+            self.writer.put_session(self.row())
+        self.rollup = None
+
+    def finish(self, end=None):
+        self.end = end if end is not None else time.time()
+        self.flush_rollup()
+        if self.writer:
+            self.writer.put_session(self.row())
+
+    def row(self):
+        return (
+            self.id,
+            self.device,
+            self.start,
+            self.end,
+            self.duration,
+            self.distance,
+            self.elevation_gain,
+            json.dumps(self.zone_seconds),
+            self.calories,
+        )
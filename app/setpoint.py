@@ -0,0 +1,193 @@
+import threading
+import time
+
+# Smallest change the treadmill understands
+SPEED_STEP = 0.1
+GRADE_STEP = 0.01
+
+def quantize(value, step):
+    return round(round(value / step) * step, 6)
+
+class Setpoint:
+    """ One rate limited value (speed or grade). `rate` is the most it may
+        change per second, 0 for no limit. `max_lead` is how far it's
+        allowed to run ahead of what the treadmill reports, so we wait for
+        the belt instead of piling on commands it hasn't caught up with.
+
+        Commands aren't acknowledged, so the polled value is the only sign
+        one arrived. Once it has stopped changing for `settle_time` seconds
+        somewhere other than what was sent, either the belt never heard us
+        (it didn't move, or was still heading our way) and the value is
+        sent again up to `max_resends` times, or someone used the console
+        (it moved off somewhere else) and we go along with it rather than
+        fighting it.
+    """
+    def __init__(self, name, step, rate, max_lead, minimum=0.0, settle_time=3.0, max_resends=2):
+        self.name = name
+        self.step = step
+        self.rate = rate
+        self.max_lead = max_lead
+        self.minimum = minimum
+        self.settle_time = settle_time
+        self.max_resends = max_resends
+        self.target = None
+        self.value = None
+        self.sent = None
+        self.sent_at = 0.0
+        self.current = None
+        # When the polled value last moved, and whether it moved
+        # towards what was sent
+        self.changed_at = 0.0
+        self.following = False
+        self.resends = 0
+        self.resend = False
+
+    def set_target(self, target):
+        target = max(target, self.minimum)
+        if self.value is None or self.value == self.target:
+            # Starting a new move, so start from where the belt actually is
+            if self.current is not None:
+                self.value = self.current
+                if self.sent is None:
+                    self.sent = quantize(self.current, self.step)
+                    self.sent_at = time.monotonic()
+        self.target = target
+
+    def feedback(self, current, now):
+        """ Takes the latest polled value, see the class docstring for what
+            happens when it doesn't match what was sent
+        """
+        previous = self.current
+        self.current = current
+        if previous is None or abs(current - previous) >= self.step / 2:
+            self.changed_at = now
+            self.following = self.sent is not None and previous is not None \
+                             and abs(current - self.sent) < abs(previous - self.sent)
+        if self.sent is None or abs(current - self.sent) < self.step / 2:
+            self.resends = 0
+            return
+        if now - self.changed_at < self.settle_time or now - self.sent_at < self.settle_time:
+            # Still moving, or hasn't had the chance to yet
+            return
+        if (self.following or self.changed_at <= self.sent_at) and self.resends < self.max_resends:
+            self.resends += 1
+            self.resend = True
+            self.sent_at = now
+            return
+        self.target = self.value = self.sent = quantize(current, self.step)
+        self.resends = 0
+
+    def advance(self, elapsed, now):
+        """ Moves towards the target. Returns the new quantized value to send
+            or None when there's nothing new to send
+        """
+        if self.target is None:
+            return None
+        if self.value is None:
+            self.value = self.target
+
+        limit = self.target
+        if self.rate:
+            step = self.rate * elapsed
+            if abs(self.target - self.value) > step:
+                limit = self.value + step if self.target > self.value else self.value - step
+        if self.current is not None and self.max_lead:
+            limit = min(max(limit, self.current - self.max_lead), self.current + self.max_lead)
+            # Never move away from the target because the belt is behind
+            if (self.target - self.value) * (limit - self.value) < 0:
+                limit = self.value
+        self.value = limit
+
+        quantized = quantize(self.value, self.step)
+        if self.value == self.target or abs(self.target - self.value) < self.step:
+            quantized = quantize(self.target, self.step)
+            self.value = self.target
+        if quantized == self.sent:
+            if self.resend:
+                self.resend = False
+                return quantized
+            return None
+        self.sent = quantized
+        self.sent_at = now
+        self.resend = False
+        return quantized
+
+
+class SetpointController:
+    """ Walks speed and grade towards their targets at limited rates and only
+        hands the dispatcher a new value when the quantized setpoint (0.1 km/h,
+        0.01 %) actually changes. Ticked from the monitor after every poll,
+        which also feeds back the polled speed and grade.
+    """
+    def __init__(self, dispatcher, speed_rate=2.0, grade_rate=1.0,
+                 speed_lead=1.0, grade_lead=1.0, max_tick=0.25):
+        self.dispatcher = dispatcher
+        self.max_tick = max_tick
+        self.lock = threading.Lock()
+        self.speed = Setpoint('speed', SPEED_STEP, speed_rate, speed_lead, minimum=1.0)
+        self.grade = Setpoint('grade', GRADE_STEP, grade_rate, grade_lead)
+        self.last_tick = time.monotonic()
+
+    def set_speed(self, target):
+        with self.lock:
+            self.speed.set_target(target)
+        self.tick()
+
+    def set_grade(self, target):
+        with self.lock:
+            self.grade.set_target(target)
+        self.tick()
+
+    def feedback(self, speed, grade):
+        now = time.monotonic()
+        with self.lock:
+            if speed is not None:
+                self.speed.feedback(speed, now)
+            if grade is not None:
+                self.grade.feedback(grade, now)
+
+    def reset(self):
+        """ Forgets the targets, for when the treadmill is stopped
+        """
+        with self.lock:
+            for setpoint in (self.speed, self.grade):
+                setpoint.target = setpoint.value = setpoint.sent = None
+                setpoint.resend = False
+                setpoint.resends = 0
+
+    def resync(self):
+        """ Sends the current setpoints again on the next tick, for when the
+            treadmill may have missed them
+        """
+        with self.lock:
+            for setpoint in (self.speed, self.grade):
+                setpoint.sent = None
+
+    def moving(self):
+        """ True while a setpoint is still ramping or the belt hasn't
+            caught up with what was last sent
+        """
+        with self.lock:
+            for setpoint in (self.speed, self.grade):
+                if setpoint.target is None:
+                    continue
+                if setpoint.value != setpoint.target:
+                    return True
+                if setpoint.current is not None and setpoint.sent is not None \
+                   and abs(setpoint.current - setpoint.sent) >= setpoint.step / 2:
+                    return True
+        return False
+
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            # Cap the step after a quiet spell so a new move doesn't
+            # jump straight to its target
+            elapsed = min(now - self.last_tick, self.max_tick)
+            self.last_tick = now
+            speed = self.speed.advance(elapsed, now)
+            grade = self.grade.advance(elapsed, now)
+        if speed is not None:
+            self.dispatcher.set_speed(speed)
+        if grade is not None:
+            self.dispatcher.set_grade(grade)
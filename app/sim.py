@@ -0,0 +1,248 @@
+import os
+import random
+import threading
+import time
+import tty
+
+from app import csafe_frames as cf
+
+class SimulatedTreadmill:
+    """ The state behind a simulated CSAFE treadmill. Speeds are kept in
+        0.1 km/h and grades in 0.01 % like the real thing reports them, but
+        as floats so that short ticks still move the belt. They're only
+        rounded when they go into a response.
+
+        The belt only moves while in use, and moves towards the requested
+        speed and grade at `acceleration` km/h and `grade_rate` % per second
+        (0 means instantly). Pressing reset on the front panel drops it back
+        to ready, and entering a user id (enter, one, ok) moves it to haveid.
+    """
+    def __init__(self, state='ready', acceleration=0.0, grade_rate=0.0,
+                 user_id='1', buttons=None):
+        self.lock = threading.Lock()
+        self.state = state
+        self.speed = 0.0
+        self.grade = 0.0
+        self.target_speed = 10
+        self.target_grade = 0
+        self.acceleration = acceleration
+        self.grade_rate = grade_rate
+        self.user_id = user_id
+        self.buttons = buttons
+        self.keypad = []
+        self.last_tick = time.monotonic()
+
+    def tick(self):
+        """ Moves the belt towards the targets for the time since the last tick
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_tick
+        self.last_tick = now
+
+        target_speed = self.target_speed if self.state == 'inuse' else 0
+        self.speed = self.approach(self.speed, target_speed, self.acceleration * 10 * elapsed)
+        self.grade = self.approach(self.grade, self.target_grade, self.grade_rate * 100 * elapsed)
+
+    def approach(self, value, target, step):
+        if not step or abs(target - value) <= step:
+            return target
+        if target > value:
+            return value + step
+        return value - step
+
+    def handle(self, contents):
+        """ Runs the commands in one request frame and returns the
+            response frame contents
+        """
+        state_codes = {name: code for code, name in cf.STATES.items()}
+        response = bytearray()
+        offset = 0
+        with self.lock:
+            self.tick()
+            while offset < len(contents):
+                command_id = contents[offset]
+                offset += 1
+                data = b''
+                if command_id < 0x80:
+                    length = contents[offset]
+                    data = contents[offset + 1:offset + 1 + length]
+                    offset += 1 + length
+                response += self.command(command_id, data)
+            return bytes([state_codes[self.state]]) + bytes(response)
+
+    def command(self, command_id, data):
+        if command_id == cf.CMD_GET_STATUS:
+            return b''
+        if command_id == cf.CMD_GET_SPEED:
+            speed = round(self.speed)
+            return bytes([command_id, 3, speed & 0xFF, speed >> 8, 0x31])
+        if command_id == cf.CMD_GET_GRADE:
+            grade = round(self.grade)
+            return bytes([command_id, 3, grade & 0xFF, grade >> 8, 0x4B])
+        if command_id == cf.CMD_GET_ID:
+            user_id = self.user_id.encode()
+            return bytes([command_id, len(user_id)]) + user_id
+        if command_id == cf.CMD_SET_SPEED:
+            self.target_speed = data[0] | (data[1] << 8)
+        elif command_id == cf.CMD_SET_GRADE:
+            self.target_grade = data[0] | (data[1] << 8)
+        elif command_id in (cf.CMD_RESET, cf.CMD_GO_READY):
+            self.state = 'ready'
+        elif command_id == cf.CMD_GO_IDLE:
+            self.state = 'idle'
+        elif command_id == cf.CMD_GO_HAVE_ID:
+            self.state = 'haveid'
+        elif command_id == cf.CMD_GO_IN_USE:
+            self.state = 'inuse'
+        elif command_id == cf.CMD_GO_FINISHED:
+            self.state = 'finished'
+        return b''
+
+    def on_gpio(self, pin, value):
+        """ GPIO listener, see app.gpio_stub
+        """
+        if not self.buttons:
+            return
+        with self.lock:
+            self.tick()
+            if pin == self.buttons['reset'] and value:
+                # Reset is active low, it's done when the pin goes back up
+                self.state = 'ready'
+                self.target_speed = 10
+                self.target_grade = 0
+                self.keypad = []
+            elif value:
+                for name in ('enter', 'one', 'ok'):
+                    if pin == self.buttons[name]:
+                        self.keypad = (self.keypad + [name])[-3:]
+                if self.keypad == ['enter', 'one', 'ok'] \
+                   and self.state in ('ready', 'idle'):
+                    self.state = 'haveid'
+
+
+class SimulatedSerial:
+    """ Stands in for serial.Serial when talking to a SimulatedTreadmill.
+        Every request and response is delayed by the time the bytes would
+        take on the wire at `baudrate`, plus the treadmill's own turnaround
+        time (`latency` seconds with up to `jitter` seconds of noise).
+    """
+    def __init__(self, treadmill=None, baudrate=9600, timeout=0.2,
+                 latency=0.02, jitter=0.0):
+        self.treadmill = treadmill or SimulatedTreadmill()
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.ready_at = 0.0
+
+    def wire_time(self, byte_count):
+        # 8N1: ten bits on the wire for every byte
+        return byte_count * 10 / self.baudrate
+
+    def write(self, data):
+        time.sleep(self.wire_time(len(data)))
+        try:
+            contents = cf.decode_frame(bytes(data))
+        except cf.FrameError:
+            return len(data)
+        response = cf.encode_frame(self.treadmill.handle(contents))
+        delay = self.latency + random.uniform(0, self.jitter) + self.wire_time(len(response))
+        with self.lock:
+            self.buffer += response
+            self.ready_at = time.monotonic() + delay
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.buffer.clear()
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            if time.monotonic() < self.ready_at:
+                return 0
+            return len(self.buffer)
+
+    def wait_for_data(self):
+        """ Sleeps until the pending response has arrived. Returns False
+            after `timeout` seconds if there's nothing to read
+        """
+        with self.lock:
+            ready_at = self.ready_at
+            available = bool(self.buffer)
+        wait = ready_at - time.monotonic()
+        if not available or wait > self.timeout:
+            time.sleep(self.timeout)
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def read_until(self, expected=b'\n', size=None):
+        if not self.wait_for_data():
+            return b''
+        with self.lock:
+            index = self.buffer.find(expected)
+            end = len(self.buffer) if index < 0 else index + len(expected)
+            data = bytes(self.buffer[:end])
+            del self.buffer[:end]
+        return data
+
+    def read(self, size=1):
+        if not self.wait_for_data():
+            return b''
+        with self.lock:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+
+class PtyTreadmill:
+    """ Serves a SimulatedTreadmill on a pseudo terminal, so anything that
+        opens a serial port (including serial.Serial) can talk to it at
+        `path`. Responses are delayed like SimulatedSerial's.
+    """
+    def __init__(self, treadmill=None, baudrate=9600, latency=0.02, jitter=0.0):
+        self.treadmill = treadmill or SimulatedTreadmill()
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+
+    def wire_time(self, byte_count):
+        return byte_count * 10 / self.baudrate
+
+    def serve(self):
+        buf = bytearray()
+        while True:
+            buf += os.read(self.master, 256)
+            while True:
+                stop = buf.find(bytes([cf.STOP]))
+                if stop < 0:
+                    break
+                frame = bytes(buf[:stop + 1])
+                del buf[:stop + 1]
+                try:
+                    contents = cf.decode_frame(frame)
+                except cf.FrameError:
+                    continue
+                response = cf.encode_frame(self.treadmill.handle(contents))
+                time.sleep(
+                    self.wire_time(len(frame))
+                    + self.latency
+                    + random.uniform(0, self.jitter)
+                    + self.wire_time(len(response))
+                )
+                os.write(self.master, response)
+
+    def run(self):
+        """ Starts serving on a background thread and returns the port path
+        """
+        self.serve_thread = threading.Thread(target=self.serve)
+        self.serve_thread.daemon = True
+        self.serve_thread.start()
+        return self.path
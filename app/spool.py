@@ -0,0 +1,342 @@
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class Spool:
+    """ Append-only on-disk spool for events that haven't made it to the
+        postgres server yet. Backed by SQLite in WAL mode with the database
+        file memory-mapped, so appends are cheap and survive a restart.
+    """
+    def __init__(self, path:str, mmap_size=64*1024*1024):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        self.conn.execute(f"pragma mmap_size={int(mmap_size)}")
+        self.conn.execute(
+            """
+            create table if not exists events (
+                id integer primary key autoincrement,
+                timestamp real not null,
+                speed real not null,
+                grade real not null,
+                device text,
+                session text
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            create table if not exists chunks (
+                id integer primary key autoincrement,
+                start real not null,
+                "end" real not null,
+                samples integer not null,
+                payload blob not null,
+                device text
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            create table if not exists sessions (
+                id integer primary key autoincrement,
+                session text not null,
+                device text,
+                start real not null,
+                "end" real,
+                duration real not null,
+                distance real not null,
+                elevation_gain real not null,
+                zones text not null,
+                calories real not null default 0
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            create table if not exists session_minutes (
+                id integer primary key autoincrement,
+                session text not null,
+                device text,
+                minute real not null,
+                seconds real not null,
+                distance real not null,
+                elevation_gain real not null,
+                avg_speed real not null,
+                max_speed real not null,
+                avg_grade real not null
+            )
+            """
+        )
+
+        # Spools written before devices were tracked
+        for table in ('events', 'chunks'):
+            columns = [row[1] for row in self.conn.execute(f"pragma table_info({table})")]
+            if 'device' not in columns:
+                self.conn.execute(f"alter table {table} add column device text")
+        # And before sessions
+        columns = [row[1] for row in self.conn.execute("pragma table_info(events)")]
+        if 'session' not in columns:
+            self.conn.execute("alter table events add column session text")
+        # And before calories
+        columns = [row[1] for row in self.conn.execute("pragma table_info(sessions)")]
+        if 'calories' not in columns:
+            self.conn.execute("alter table sessions add column calories real not null default 0")
+        self.conn.commit()
+
+    def append(self, events):
+        """ Appends a batch of (timestamp, speed, grade, device, session) events
+        """
+        rows = [
+            (timestamp.timestamp(), speed, grade, device, session)
+            for timestamp, speed, grade, device, session in events
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "insert into events ( timestamp, speed, grade, device, session ) values ( ?, ?, ?, ?, ? )",
+                rows
+            )
+            self.conn.commit()
+
+    def peek(self, limit:int):
+        """ Returns up to `limit` of the oldest spooled events as
+            (id, timestamp, speed, grade, device, session) without removing them
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "select id, timestamp, speed, grade, device, session from events order by id limit ?",
+                (limit,)
+            ).fetchall()
+        return [
+            (
+                id_,
+                datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+                speed,
+                grade,
+                device,
+                session,
+            )
+            for id_, timestamp, speed, grade, device, session in rows
+        ]
+
+    def ack(self, last_id:int):
+        """ Removes every event up to and including `last_id`
+        """
+        with self.lock:
+            self.conn.execute("delete from events where id <= ?", (last_id,))
+            self.conn.commit()
+
+    def append_chunks(self, chunks):
+        """ Appends a batch of (start, end, samples, payload, device) capture chunks
+        """
+        with self.lock:
+            self.conn.executemany(
+                'insert into chunks ( start, "end", samples, payload, device ) values ( ?, ?, ?, ?, ? )',
+                chunks
+            )
+            self.conn.commit()
+
+    def peek_chunks(self, limit:int):
+        """ Returns up to `limit` of the oldest spooled chunks as
+            (id, start, end, samples, payload, device) without removing them
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'select id, start, "end", samples, payload, device from chunks order by id limit ?',
+                (limit,)
+            ).fetchall()
+        return [
+            (
+                id_,
+                datetime.datetime.fromtimestamp(start, datetime.timezone.utc),
+                datetime.datetime.fromtimestamp(end, datetime.timezone.utc),
+                samples,
+                payload,
+                device,
+            )
+            for id_, start, end, samples, payload, device in rows
+        ]
+
+    def ack_chunks(self, last_id:int):
+        """ Removes every chunk up to and including `last_id`
+        """
+        with self.lock:
+            self.conn.execute("delete from chunks where id <= ?", (last_id,))
+            self.conn.commit()
+
+    def append_sessions(self, sessions):
+        """ Appends a batch of session summaries, see Session.row(). Every
+            update to a session is a new row, the drainer keeps the latest
+        """
+        with self.lock:
+            self.conn.executemany(
+                """
+                insert into sessions
+                ( session, device, start, "end", duration, distance, elevation_gain, zones, calories )
+                values ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+                """,
+                sessions
+            )
+            self.conn.commit()
+
+    def peek_sessions(self, limit:int):
+        """ Returns up to `limit` of the oldest spooled session summaries as
+            (id, session, device, start, end, duration, distance,
+            elevation gain, zones, calories) without removing them
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                select id, session, device, start, "end", duration, distance, elevation_gain, zones, calories
+                from sessions order by id limit ?
+                """,
+                (limit,)
+            ).fetchall()
+        return [
+            (
+                id_,
+                session,
+                device,
+                datetime.datetime.fromtimestamp(start, datetime.timezone.utc),
+                datetime.datetime.fromtimestamp(end, datetime.timezone.utc) if end is not None else None,
+                *totals,
+            )
+            for id_, session, device, start, end, *totals in rows
+        ]
+
+    def ack_sessions(self, last_id:int):
+        """ Removes every session summary up to and including `last_id`
+        """
+        with self.lock:
+            self.conn.execute("delete from sessions where id <= ?", (last_id,))
+            self.conn.commit()
+
+    def append_rollups(self, rollups):
+        """ Appends a batch of per-minute session rollups, see Rollup.row()
+        """
+        with self.lock:
+            self.conn.executemany(
+                """
+                insert into session_minutes
+                ( session, device, minute, seconds, distance, elevation_gain, avg_speed, max_speed, avg_grade )
+                values ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+                """,
+                rollups
+            )
+            self.conn.commit()
+
+    def peek_rollups(self, limit:int):
+        """ Returns up to `limit` of the oldest spooled rollups as (id,
+            session, device, minute, seconds, distance, elevation gain,
+            average speed, max speed, average grade) without removing them
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                select id, session, device, minute, seconds, distance, elevation_gain, avg_speed, max_speed, avg_grade
+                from session_minutes order by id limit ?
+                """,
+                (limit,)
+            ).fetchall()
+        return [
+            (
+                id_,
+                session,
+                device,
+                datetime.datetime.fromtimestamp(minute, datetime.timezone.utc),
+                *totals,
+            )
+            for id_, session, device, minute, *totals in rows
+        ]
+
+    def ack_rollups(self, last_id:int):
+        """ Removes every rollup up to and including `last_id`
+        """
+        with self.lock:
+            self.conn.execute("delete from session_minutes where id <= ?", (last_id,))
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("select count(*) from events").fetchone()[0]
+
+
+class SpoolDrainer:
+    """ Replays the spool into the postgres server in bulk. Replay is capped
+        at `max_rate` rows per second so a long backlog doesn't flood the
+        server when it comes back, and failures back off exponentially.
+    """
+    def __init__(self, spool, db, batch_size=500, chunk_batch_size=20,
+                 max_rate=1000.0, idle_interval=2.0, max_backoff=60.0):
+        self.spool = spool
+        self.db = db
+        self.batch_size = batch_size
+        self.chunk_batch_size = chunk_batch_size
+        self.max_rate = max_rate
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.backoff = idle_interval
+        self.healthy = True
+
+    def drain_once(self):
+        """ Pushes one batch of everything spooled to the server in a single
+            transaction. Returns the number of rows sent
+        """
+        rows = self.spool.peek(self.batch_size)
+        chunks = self.spool.peek_chunks(self.chunk_batch_size)
+        rollups = self.spool.peek_rollups(self.batch_size)
+        sessions = self.spool.peek_sessions(self.batch_size)
+        if not (rows or chunks or rollups or sessions):
+            return 0
+
+        self.db.write(
+            events=[row[1:] for row in rows],
+            chunks=[chunk[1:] for chunk in chunks],
+            rollups=[rollup[1:] for rollup in rollups],
+            sessions=[session[1:] for session in sessions],
+        )
+
+        if rows:
+            self.spool.ack(rows[-1][0])
+        if chunks:
+            self.spool.ack_chunks(chunks[-1][0])
+        if rollups:
+            self.spool.ack_rollups(rollups[-1][0])
+        if sessions:
+            self.spool.ack_sessions(sessions[-1][0])
+        return len(rows) + len(chunks) + len(rollups) + len(sessions)
+
+    def drain_loop(self):
+        while True:
+            try:
+                sent = self.drain_once()
+            except Exception as ex:
+                if self.healthy:
+                    log.error("Database unavailable, spooling locally: %s", ex)
+                self.healthy = False
+                time.sleep(self.backoff)
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                continue
+
+            if not self.healthy:
+                log.info("Database is back, replaying spool")
+            self.healthy = True
+            self.backoff = self.idle_interval
+
+            if sent < self.batch_size:
+                time.sleep(self.idle_interval)
+            else:
+                time.sleep(sent / self.max_rate)
+
+    def run(self):
+        """ Starts the drain thread
+        """
+        self.drain_thread = threading.Thread(target=self.drain_loop)
+        self.drain_thread.daemon = True
+        self.drain_thread.start()
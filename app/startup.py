@@ -0,0 +1,53 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+class StartupReport:
+    """ Keeps track of how long each subsystem took to come up. Sections may
+        run concurrently, so alongside each one's own duration the report
+        shows when it finished relative to the start of the process.
+    """
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.last_mark = self.origin
+        self.lock = threading.Lock()
+        self.sections = []
+
+    def mark(self, name):
+        """ Records a section covering everything since the previous mark
+        """
+        toc = time.monotonic()
+        with self.lock:
+            self.sections.append((name, toc - self.last_mark, toc - self.origin))
+            self.last_mark = toc
+
+    @contextmanager
+    def section(self, name):
+        tic = time.monotonic()
+        try:
+            yield
+        finally:
+            toc = time.monotonic()
+            with self.lock:
+                self.sections.append((name, toc - tic, toc - self.origin))
+
+    def timed(self, name, fn, *args):
+        """ Returns a callable that runs fn(*args) inside a section, handy
+            for run_in_executor
+        """
+        def run():
+            with self.section(name):
+                return fn(*args)
+        return run
+
+    def report(self):
+        with self.lock:
+            sections = sorted(self.sections, key=lambda section: section[2])
+        lines = ["Startup times:"]
+        for name, duration, finished in sections:
+            lines.append(f"  {name:<24} {duration:7.3f}s  (done at {finished:7.3f}s)")
+        lines.append(f"  {'total':<24} {time.monotonic() - self.origin:7.3f}s")
+        return "\n".join(lines)
+
+REPORT = StartupReport()
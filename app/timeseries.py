@@ -0,0 +1,280 @@
+import collections
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# What a query can ask for, as SQL over the rows in a bucket. Averages are
+# weighted by the seconds each row covers
+AGGREGATES = {
+    'samples': "count(*)",
+    'duration': "sum(seconds)",
+    'distance': "sum(distance)",
+    'elevation_gain': "sum(climb)",
+    'avg_speed': "sum(speed * seconds) / nullif(sum(seconds), 0)",
+    'min_speed': "min(speed)",
+    'max_speed': "max(max_speed)",
+    'avg_grade': "sum(grade * seconds) / nullif(sum(seconds), 0)",
+    'min_grade': "min(grade)",
+    'max_grade': "max(grade)",
+}
+
+class Second:
+    """ One second of polls from one device, folded into a row as they
+        come in
+    """
+    def __init__(self, second, session):
+        self.second = second
+        self.session = session
+        self.seconds = 0.0
+        self.distance = 0.0
+        self.climb = 0.0
+        self.speed_seconds = 0.0
+        self.grade_seconds = 0.0
+        self.max_speed = 0.0
+
+    def row(self, device):
+        seconds = self.seconds or 1.0
+        return (
+            device,
+            self.second,
+            self.session,
+            self.seconds,
+            self.distance,
+            self.climb,
+            self.speed_seconds / seconds,
+            self.max_speed,
+            self.grade_seconds / seconds,
+        )
+
+
+class TimeSeries:
+    """ Local store of what the treadmills did, one row per device per
+        second of use, so history questions never go to postgres. The
+        monitor hands every poll to add(), which only does arithmetic and
+        queues finished seconds for the store's own thread to insert. Rows
+        are indexed by device and time, and by session.
+
+        Query results are kept in an LRU cache. A result whose range is
+        entirely behind the newest row can't change and stays valid, one
+        reaching up to the present is dropped once more rows arrive.
+    """
+    def __init__(self, path:str, retention_days=365, cache_size=128, max_gap=5.0,
+                 max_queue=5000, flush_interval=2.0):
+        self.path = path
+        self.retention = retention_days * 86400
+        self.max_gap = max_gap
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+        # Per device: the last poll and the second being filled
+        self.last = {}
+        self.current = {}
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        self.conn.execute(
+            """
+            create table if not exists samples (
+                device text not null,
+                timestamp real not null,
+                session text,
+                seconds real not null,
+                distance real not null,
+                climb real not null,
+                speed real not null,
+                max_speed real not null,
+                grade real not null
+            )
+            """
+        )
+        self.conn.execute("create index if not exists samples_device_time on samples ( device, timestamp )")
+        self.conn.execute("create index if not exists samples_time on samples ( timestamp )")
+        self.conn.execute("create index if not exists samples_session on samples ( session )")
+        self.conn.commit()
+
+        # Queries read through their own connection so they never wait
+        # for an insert, WAL lets the two run side by side
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.read_lock = threading.Lock()
+
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        # Bumped whenever rows are written or pruned. newest is the
+        # timestamp of the latest row written
+        self.version = 0
+        self.newest = 0.0
+
+    def add(self, device:str, timestamp:float, speed:float, grade:float, session:str=None):
+        """ Takes one poll while the treadmill is in use. Between two polls
+            the treadmill is taken to hold the earlier poll's speed and grade,
+            as in app.sessions
+        """
+        last = self.last.get(device)
+        self.last[device] = (timestamp, speed, grade)
+        if last is None:
+            return
+        last_timestamp, last_speed, last_grade = last
+        dt = min(max(timestamp - last_timestamp, 0.0), self.max_gap)
+        distance = last_speed * dt / 3600
+        climb = distance * 1000 * last_grade / 100 if last_grade > 0 else 0.0
+
+        second = math.floor(last_timestamp)
+        current = self.current.get(device)
+        if current is not None and (current.second != second or current.session != session):
+            self.enqueue(current.row(device))
+            current = None
+        if current is None:
+            current = self.current[device] = Second(second, session)
+        current.seconds += dt
+        current.distance += distance
+        current.climb += climb
+        current.speed_seconds += last_speed * dt
+        current.grade_seconds += last_grade * dt
+        current.max_speed = max(current.max_speed, last_speed)
+
+    def pause(self, device:str):
+        """ The treadmill stopped being in use, the time until it's back
+            doesn't count
+        """
+        self.last.pop(device, None)
+        current = self.current.pop(device, None)
+        if current is not None:
+            self.enqueue(current.row(device))
+
+    def enqueue(self, row):
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def insert(self, rows):
+        self.conn.executemany(
+            """
+            insert into samples ( device, timestamp, session, seconds, distance, climb, speed, max_speed, grade )
+            values ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+            """,
+            rows
+        )
+        self.conn.commit()
+        with self.cache_lock:
+            self.version += 1
+            self.newest = max(self.newest, max(row[1] for row in rows))
+
+    def prune(self):
+        """ Drops rows older than the retention period
+        """
+        cursor = self.conn.execute("delete from samples where timestamp < ?", (time.time() - self.retention,))
+        self.conn.commit()
+        if cursor.rowcount:
+            log.info("Pruned %d rows from the local history", cursor.rowcount)
+            with self.cache_lock:
+                self.version += 1
+                self.cache.clear()
+
+    def writer_loop(self):
+        last_prune = 0.0
+        while True:
+            rows = [self.queue.get()]
+            # Gather whatever else turns up within the flush interval
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.insert(rows)
+                if time.monotonic() - last_prune > 3600:
+                    last_prune = time.monotonic()
+                    self.prune()
+            except Exception as ex:
+                log.error("Could not store %d rows in the local history: %s", len(rows), ex)
+
+    def run(self):
+        """ Starts the writer thread
+        """
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def query(self, start:float, end:float, aggregates, device:str=None, session:str=None,
+              bucket:float=None):
+        """ Returns the `aggregates` for [start, end) as totals and, with a
+            `bucket` in seconds, as a series with one entry per bucket that
+            has data
+        """
+        if not aggregates:
+            raise ValueError("ask for at least one aggregate")
+        for name in aggregates:
+            if name not in AGGREGATES:
+                raise ValueError(f"Unknown aggregate '{name}'")
+        if end <= start:
+            raise ValueError("end must be after start")
+        if bucket is not None and bucket <= 0:
+            raise ValueError("bucket must be positive")
+
+        key = (start, end, tuple(aggregates), device, session, bucket)
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and (entry[0] is None or entry[0] == self.version):
+                self.cache.move_to_end(key)
+                return entry[1]
+            # Rows from different devices arrive a second or two out of
+            # order, so only a range well behind the newest row is settled
+            version = None if end <= self.newest - 60 else self.version
+
+        where = ["timestamp >= ?", "timestamp < ?"]
+        params = [start, end]
+        if device is not None:
+            where.append("device = ?")
+            params.append(device)
+        if session is not None:
+            where.append("session = ?")
+            params.append(session)
+        columns = ", ".join(AGGREGATES[name] for name in aggregates)
+        where = " and ".join(where)
+
+        with self.read_lock:
+            totals = self.reader.execute(f"select {columns} from samples where {where}", params).fetchone()
+            series = None
+            if bucket is not None:
+                series = self.reader.execute(
+                    f"""
+                    select cast((timestamp - ?) / ? as integer) as bucket, {columns}
+                    from samples where {where}
+                    group by bucket order by bucket
+                    """,
+                    [start, bucket] + params
+                ).fetchall()
+
+        result = {
+            'start': start,
+            'end': end,
+            'device': device,
+            'session': session,
+            'totals': dict(zip(aggregates, totals)),
+        }
+        if series is not None:
+            result['bucket'] = bucket
+            result['series'] = [
+                {'time': start + row[0] * bucket, **dict(zip(aggregates, row[1:]))}
+                for row in series
+            ]
+
+        with self.cache_lock:
+            self.cache[key] = (version, result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
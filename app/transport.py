@@ -0,0 +1,152 @@
+import logging
+import time
+
+import serial
+
+log = logging.getLogger(__name__)
+
+class SerialSupervisor:
+    """ Stands in for serial.Serial and keeps the link to the treadmill
+        alive. An IO error, or `max_timeouts` requests in a row without a
+        response spread over at least `max_silence` seconds, closes the port
+        and the next request reopens it. The console is silent for a few
+        seconds whenever it reboots, so a short silence isn't enough, and
+        start() declares the reboot it causes with expect_silence(). The port
+        is found again by its USB serial number when one is given, since the
+        adapter can come back under a different /dev/ttyUSB name. Reopen
+        attempts back off exponentially up to `max_backoff` seconds, so the
+        link is back at most that long after the adapter is.
+
+        Everything here runs on the dispatcher thread, requests made while
+        the port is down fail straight away rather than blocking it.
+    """
+    def __init__(self, port, baudrate=9600, timeout=0.2, serial_number=None,
+                 max_timeouts=5, max_silence=15.0, min_backoff=0.5, max_backoff=30.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial_number = serial_number
+        self.max_timeouts = max_timeouts
+        self.max_silence = max_silence
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.serial = None
+        self.path = None
+        self.timeouts = 0
+        self.last_data = time.monotonic()
+        self.quiet_until = 0.0
+        self.backoff = min_backoff
+        self.next_attempt = 0.0
+        self.down_since = None
+        # Bumped on every reopen so the device knows to resync
+        self.reconnects = 0
+
+    @property
+    def connected(self):
+        return self.serial is not None
+
+    def find_port(self):
+        """ Returns the device path, looking it up by serial number if we
+            have one
+        """
+        if not self.serial_number:
+            return self.port
+        from serial.tools import list_ports
+        for info in list_ports.comports():
+            if info.serial_number == self.serial_number:
+                return info.device
+        raise serial.SerialException(f"No serial adapter with serial number {self.serial_number}")
+
+    def open(self):
+        reopening = self.path is not None
+        path = self.find_port()
+        self.serial = serial.Serial(path, self.baudrate, timeout=self.timeout)
+        self.path = path
+        self.timeouts = 0
+        self.last_data = time.monotonic()
+        self.backoff = self.min_backoff
+        if reopening:
+            self.reconnects += 1
+            log.warning(
+                "Serial link on %s is back after %.1fs",
+                path, time.monotonic() - (self.down_since or time.monotonic())
+            )
+        self.down_since = None
+
+    def ensure_open(self):
+        if self.serial is not None:
+            return
+        now = time.monotonic()
+        if now < self.next_attempt:
+            raise serial.SerialException(f"Serial link on {self.path or self.port} is down")
+        try:
+            self.open()
+        except (serial.SerialException, OSError) as ex:
+            self.next_attempt = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            raise serial.SerialException(f"Could not reopen {self.path or self.port}: {ex}")
+
+    def fail(self, reason):
+        """ Drops the port, the next request tries to reopen it
+        """
+        log.error("Serial link on %s failed: %s", self.path or self.port, reason)
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        self.serial = None
+        self.next_attempt = time.monotonic() + self.backoff
+
+    def call(self, method, *args, **kwargs):
+        self.ensure_open()
+        try:
+            return getattr(self.serial, method)(*args, **kwargs)
+        except (serial.SerialException, OSError) as ex:
+            self.fail(ex)
+            raise
+
+    def expect_silence(self, seconds):
+        """ The treadmill is about to go quiet for up to `seconds`, e.g.
+            rebooting after a reset, so timeouts until then don't count
+        """
+        self.quiet_until = time.monotonic() + seconds
+
+    def received(self, data):
+        now = time.monotonic()
+        if data:
+            self.timeouts = 0
+            self.last_data = now
+            return data
+        if now < self.quiet_until:
+            return data
+        self.timeouts += 1
+        if self.timeouts >= self.max_timeouts and now - max(self.last_data, self.quiet_until) >= self.max_silence:
+            self.fail(f"no response to {self.timeouts} requests in {now - self.last_data:.0f}s")
+        return data
+
+    def write(self, data):
+        return self.call('write', data)
+
+    def read(self, size=1):
+        return self.received(self.call('read', size))
+
+    def read_until(self, expected=b'\n', size=None):
+        return self.received(self.call('read_until', expected, size))
+
+    def reset_input_buffer(self):
+        return self.call('reset_input_buffer')
+
+    def flush(self):
+        return self.call('flush')
+
+    @property
+    def in_waiting(self):
+        return self.call('__getattribute__', 'in_waiting')
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
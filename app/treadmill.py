@@ -1,71 +1,126 @@
 from csafe import Controller, STATUSES
 
-import RPi.GPIO as GPIO
+from app import csafe_frames
+from app.metrics import SERIAL_TIMEOUTS, START_STEP
+
+import logging
 import time
 
+import serial
+
+log = logging.getLogger(__name__)
+
+# Set by load_gpio()
+GPIO = None
+
+def load_gpio(simulate=False):
+    """ Picks what the front panel buttons are pressed through: the stub
+        when simulating, so the simulated treadmill sees the presses, and
+        RPi.GPIO otherwise. Without RPi.GPIO (not a Pi, or no access to
+        /dev/mem) the buttons can't work, which is logged as an error
+    """
+    global GPIO
+    if simulate:
+        from app import gpio_stub
+        GPIO = gpio_stub
+    elif GPIO is None:
+        try:
+            import RPi.GPIO as rpi_gpio
+            GPIO = rpi_gpio
+        except (ImportError, RuntimeError) as ex:
+            log.error("Can't use RPi.GPIO, the front panel buttons won't work: %s", ex)
+            from app import gpio_stub
+            GPIO = gpio_stub
+    return GPIO
+
 RESET = 4
 ENTER = 5
 ONE = 6
 OK = 26
 
-def button_handler_init():
-    print("RESET BUTTONS")
+# Default wiring of the front panel buttons to the GPIO pins. Each
+# treadmill on the same Pi needs its own set
+BUTTONS = {
+    'reset': RESET,
+    'enter': ENTER,
+    'one': ONE,
+    'ok': OK,
+}
+
+def button_handler_init(buttons=BUTTONS):
+    log.info("Reset buttons")
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(ENTER, GPIO.OUT)
-    GPIO.output(ENTER, False)
-    GPIO.setup(ONE, GPIO.OUT)
-    GPIO.output(ONE, False)
-    GPIO.setup(OK, GPIO.OUT)
-    GPIO.output(OK, False)
-    GPIO.setup(RESET, GPIO.OUT)
-    GPIO.output(RESET, True)
-
-def press_enter():
-    print("PRESS ENTER")
-    GPIO.output(ENTER, True)
+    GPIO.setup(buttons['enter'], GPIO.OUT)
+    GPIO.output(buttons['enter'], False)
+    GPIO.setup(buttons['one'], GPIO.OUT)
+    GPIO.output(buttons['one'], False)
+    GPIO.setup(buttons['ok'], GPIO.OUT)
+    GPIO.output(buttons['ok'], False)
+    GPIO.setup(buttons['reset'], GPIO.OUT)
+    GPIO.output(buttons['reset'], True)
+
+def press_enter(pin=ENTER):
+    log.debug("Press enter")
+    GPIO.output(pin, True)
     time.sleep(0.1)
-    GPIO.output(ENTER, False)
+    GPIO.output(pin, False)
 
-def press_one():
-    print("PRESS ONE")
-    GPIO.output(ONE, True)
+def press_one(pin=ONE):
+    log.debug("Press one")
+    GPIO.output(pin, True)
     time.sleep(0.1)
-    GPIO.output(ONE, False)
+    GPIO.output(pin, False)
 
-def press_ok():
-    print("PRESS OK")
-    GPIO.output(OK, True)
+def press_ok(pin=OK):
+    log.debug("Press ok")
+    GPIO.output(pin, True)
     time.sleep(0.1)
-    GPIO.output(OK, False)
+    GPIO.output(pin, False)
 
-def press_reset():
-    GPIO.output(RESET, False)
+def press_reset(pin=RESET):
+    GPIO.output(pin, False)
     time.sleep(0.1)
-    GPIO.output(RESET, True)
+    GPIO.output(pin, True)
 
-def enter_user_id():
-    time.sleep(0.2)
-    press_enter()
-    time.sleep(0.5)
-    press_one()
-    time.sleep(0.5)
-    press_ok()
-    time.sleep(0.5)
+def enter_user_id(buttons=BUTTONS, key_gap=0.25):
+    """ Types user id 1 on the keypad, leaving `key_gap` seconds between
+        the keys for the console to keep up
+    """
+    press_enter(buttons['enter'])
+    time.sleep(key_gap)
+    press_one(buttons['one'])
+    time.sleep(key_gap)
+    press_ok(buttons['ok'])
+
+class StartError(Exception):
+    pass
 
 class Treadmill:
-    def __init__(self, transport, debug=False):
+    def __init__(self, transport, debug=False, batched_status=True, buttons=None,
+                 batch_probe_interval=60.0):
+        self.transport = transport
+        self.buttons = dict(BUTTONS, **(buttons or {}))
         self.csafe = Controller(transport, debug=debug, get_packet_iterations=1)
 
+        # Poll status, speed and grade in a single CSAFE frame. Falls back
+        # to one command per frame if the treadmill keeps sending bad
+        # answers to it, and tries it again every `batch_probe_interval`
+        self.batched_status = batched_status
+        self.batch_failures = 0
+        self.batch_probe_interval = batch_probe_interval
+        self.batch_off_until = None
+
         # To handle the button actions
-        button_handler_init()
+        if GPIO is None:
+            load_gpio()
+        button_handler_init(self.buttons)
 
         # Just for fun
         self.status_string = ''
 
-    def status(self):
-        status_data = csafe.get_status()
-        print("!!! STATUS:", status_data.status)
+        # How long each step of the last start() took
+        self.start_timings = {}
 
     def reset(self):
         """ Resets the treadmill by "hitting" the big red button a couple of times
@@ -77,61 +132,182 @@ class Treadmill:
     def stop(self):
         """ Hits the reset button for 0.1s once
         """
-        press_reset()
+        press_reset(self.buttons['reset'])
 
     def set_speed(self, new_speed):
         """ Send the CSAFE command to change the speed of the treadmill
         """
-        normalized_new_speed = int(new_speed * 10)
-        print(f"New speed is {normalized_new_speed/10} km/hour")
+        normalized_new_speed = int(round(new_speed * 10))
+        log.debug("New speed is %s km/hour", normalized_new_speed / 10)
         self.csafe.set_speed(normalized_new_speed, '0.1 km/hour', _wait_response=False)
 
     def set_grade(self, new_grade):
         """ Send the CSAFE command to change the grade of the treadmill
         """
-        normalized_new_grade = int(new_grade * 100)
-        print(f"New grade is {normalized_new_grade/100} %")
+        normalized_new_grade = int(round(new_grade * 100))
+        log.debug("New grade is %s %%", normalized_new_grade / 100)
         self.csafe.set_grade(normalized_new_grade, '0.01 % grade', _wait_response=False)
 
     def status(self):
+        """ Returns the treadmill's status along with the speed in km/h
+            and the grade in %
+        """
+        status = None
+        now = time.monotonic()
+        if self.batched_status and (self.batch_off_until is None or now >= self.batch_off_until):
+            try:
+                status = csafe_frames.query_status(self.transport)
+                if self.batch_off_until is not None:
+                    log.info("Batched status polls work again")
+                self.batch_failures = 0
+                self.batch_off_until = None
+            except csafe_frames.FrameTimeout:
+                # The console is silent, e.g. rebooting after a reset. That
+                # says nothing about batching and asking again one command
+                # at a time would only time out again
+                return
+            except csafe_frames.FrameError as ex:
+                log.warning("Batched status poll failed: %s", ex)
+                self.batch_failures += 1
+                if self.batch_off_until is not None:
+                    self.batch_off_until = now + self.batch_probe_interval
+                elif self.batch_failures >= 3:
+                    log.warning("Falling back to one command per frame status polls")
+                    self.batch_off_until = now + self.batch_probe_interval
+
+        if status is None:
+            status = self.status_sequential()
+            if not status:
+                return
+
+        status_string = f"{status['status']}: {status['speed']:.1f} km/hour {status['grade']:.2f} % grade"
+        if status_string != self.status_string:
+            log.info(status_string)
+            self.status_string = status_string
+        return status
+
+    def status_sequential(self):
+        """ Polls status, speed and grade with one CSAFE request each
+        """
         status_message = self.csafe.get_status()
         if not status_message:
+            # Frames sent through csafe_frames.query() count their own
+            # timeouts, this one went through the csafe library
+            SERIAL_TIMEOUTS.inc(getattr(self.transport, 'port', None))
             return
-        status = status_message.status
         speed = self.csafe.get_speed()
         grade = self.csafe.get_grade()
-        status_string = f"{status}: {speed.value} {speed.unit} {grade.value} {grade.unit}"
-        if status_string != self.status_string:
-            print(status_string)
-            self.status_string = status_string
         return {
-            'status': status,
-            'speed': speed,
-            'grade': grade,
+            'status': status_message.status,
+            'speed': speed.value.value / 10,
+            'grade': grade.value.value / 100,
         }
 
-    def start(self, update_status):
+    def resync(self):
+        """ Gets back in step with the treadmill after the serial port was
+            reopened: drops anything half read and checks the CSAFE state.
+            If the treadmill lost track of us it's put back through the
+            CSAFE side of start()
+        """
+        self.transport.reset_input_buffer()
+        self.status_string = ''
+        status = self.status()
+        if status is None or status['status'] in ('error', 'offline'):
+            log.warning("Treadmill is %s after reconnecting, resetting CSAFE", status and status['status'])
+            csafe_frames.query(self.transport, [csafe_frames.CMD_RESET])
+            self.step('resync', self.csafe_command(csafe_frames.CMD_GO_IDLE), ('idle',), 2.0, 2)
+            status = self.status()
+        return status
+
+    def wait_for_state(self, states, timeout, interval=0.05):
+        """ Polls the CSAFE status until it's one of `states`. Returns the
+            state, or None if it didn't get there within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                state, _ = csafe_frames.query(self.transport, [csafe_frames.CMD_GET_STATUS])
+            except Exception as ex:
+                # Still rebooting after a reset, or just a bad frame
+                log.debug("Waiting for %s: %s", '/'.join(states), ex)
+                state = None
+            if state in states:
+                return state
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
+    def step(self, name, action, states, timeout, retries):
+        """ Runs `action` until the treadmill reaches one of `states`, giving
+            each attempt `timeout` seconds. Records how long it took
+        """
+        tic = time.monotonic()
+        for attempt in range(retries + 1):
+            if attempt:
+                log.warning("Start step '%s' didn't get there, retrying (%d/%d)", name, attempt, retries)
+            try:
+                action()
+            except (csafe_frames.FrameError, serial.SerialException) as ex:
+                # A lost or garbled command frame, the retry sends it again
+                log.warning("Start step '%s' failed: %s", name, ex)
+                continue
+            state = self.wait_for_state(states, timeout)
+            if state:
+                elapsed = time.monotonic() - tic
+                self.start_timings[name] = elapsed
+                START_STEP.observe(elapsed, name)
+                return state
+        raise StartError(f"Treadmill didn't reach {'/'.join(states)} during '{name}'")
+
+    def csafe_command(self, command_id):
+        return lambda: csafe_frames.query(self.transport, [command_id])
+
+    def start(self, update_status, step_timeout=2.0, reset_timeout=8.0,
+              reset_settle=0.5, key_gap=0.25, retries=2):
+        """ Takes the treadmill from whatever it's doing to running. Every
+            step polls the CSAFE state and moves on as soon as the treadmill
+            gets there, instead of sleeping for as long as it could take.
+            Raises StartError if a step still fails after `retries` retries
+        """
+        self.start_timings = {}
+        tic = time.monotonic()
+
+        # The console reboots after a reset and answers again once it's
+        # ready. Give it a moment to go down first so we don't catch the
+        # state from before the reset
+        def reset():
+            # Don't let the serial supervisor take the reboot for a dead link
+            expect_silence = getattr(self.transport, 'expect_silence', None)
+            if expect_silence:
+                expect_silence(reset_settle + reset_timeout)
+            self.reset()
+            time.sleep(reset_settle)
+
         update_status('Resetting')
-        self.reset()
-        time.sleep(5.0)
-        update_status('CSAFE Reset')
-        self.csafe.reset()
+        self.step('reset', reset, ('ready', 'idle'), reset_timeout, retries)
+
         update_status('Idle')
-        self.csafe.go_idle()
-        self.csafe.get_packet()
+        self.step('idle', self.csafe_command(csafe_frames.CMD_GO_IDLE), ('idle',), step_timeout, retries)
 
-        # Insert our user id
+        # Insert our user id. The keypad gives no feedback until the id is in
         update_status('User Enter')
-        enter_user_id()
-        user_id = self.csafe.get_id()
-        print(f"!!!! GOT THE user id {user_id}")
+        self.step('user id', lambda: enter_user_id(self.buttons, key_gap), ('haveid',), step_timeout, retries)
+        try:
+            _, responses = csafe_frames.query(self.transport, [csafe_frames.CMD_GET_ID])
+            log.info("Got the user id %s", bytes(responses.get(csafe_frames.CMD_GET_ID, b'')).decode(errors='replace'))
+        except (csafe_frames.FrameError, serial.SerialException) as ex:
+            # Only logged, the treadmill has the id either way
+            log.warning("Could not read back the user id: %s", ex)
 
         # Then we move the treadmill into the active state
         update_status('Starting')
-        time.sleep(0.5)
-
-        self.csafe.go_inuse()
-
-
+        self.step('in use', self.csafe_command(csafe_frames.CMD_GO_IN_USE), ('inuse',), step_timeout, retries)
 
-                
+        self.start_timings['total'] = time.monotonic() - tic
+        START_STEP.observe(self.start_timings['total'], 'total')
+        log.info(
+            "Started in %.2fs (%s)",
+            self.start_timings['total'],
+            ', '.join(f"{name} {elapsed:.2f}s" for name, elapsed in self.start_timings.items() if name != 'total')
+        )
+        return self.start_timings
@@ -1,5 +1,18 @@
-import threading
-from nicegui import ui
+import itertools
+import json
+import math
+import time
+
+from fastapi.responses import JSONResponse, PlainTextResponse
+from nicegui import Client, app as nicegui_app, ui
+
+from app.history import lttb
+from app.logs import RECENT
+from app.metrics import METRICS
+from app.publish import STATE
+from app.timeseries import AGGREGATES
+
+from app.uistate import ViewState
 
 style = """
 <style>
@@ -75,45 +88,239 @@ style = """
 </style>
 """
 
+# Runs the elapsed and HIIT clocks in the browser. The server only sends
+# the clock's value and direction when it starts or stops, and the page
+# counts from the moment it first sees each timer token
+timer_script = """
+<script>
+(function () {
+    const seen = {};
+    function format(elapsed) {
+        elapsed = Math.max(elapsed, 0);
+        const minutes = Math.floor(elapsed / 60);
+        const seconds = elapsed - minutes * 60;
+        return String(minutes).padStart(2, '0') + ':' + seconds.toFixed(2).padStart(5, '0');
+    }
+    setInterval(function () {
+        const now = performance.now() / 1000;
+        document.querySelectorAll('[data-timer-token]').forEach(function (element) {
+            const token = element.dataset.timerToken;
+            if (!(token in seen)) {
+                seen[token] = now;
+            }
+            const elapsed = parseFloat(element.dataset.timerElapsed);
+            const direction = parseFloat(element.dataset.timerDirection);
+            element.textContent = format(elapsed + direction * (now - seen[token]));
+        });
+    }, 50);
+})();
+</script>
+"""
+
+TIMER_TOKENS = itertools.count()
+
+# Feeds the speed/incline chart. The server only sends the points added since
+# its last update on a hidden element, in data-chart-* attributes, and the
+# page appends them to the chart and drops whatever has scrolled out of the
+# window. A reset replaces the whole series, for a new client or window or
+# a downsampled view
+chart_script = """
+<script>
+(function () {
+    const seen = {};
+    function findChart(target) {
+        if (!target || !window.Highcharts) {
+            return null;
+        }
+        return Highcharts.charts.find(function (chart) {
+            return chart && (chart.renderTo === target || target.contains(chart.renderTo));
+        });
+    }
+    setInterval(function () {
+        document.querySelectorAll('[data-chart-for]').forEach(function (feed) {
+            const chart = findChart(document.getElementById(feed.dataset.chartFor));
+            if (!chart || seen[feed.id] === feed.dataset.chartSeq) {
+                return;
+            }
+            seen[feed.id] = feed.dataset.chartSeq;
+            const data = [JSON.parse(feed.dataset.chartSpeed || '[]'), JSON.parse(feed.dataset.chartGrade || '[]')];
+            if (feed.dataset.chartMode === 'reset') {
+                chart.series[0].setData(data[0], false);
+                chart.series[1].setData(data[1], false);
+            } else {
+                data.forEach(function (points, i) {
+                    const series = chart.series[i];
+                    points.forEach(function (point) {
+                        series.addPoint(point, false);
+                    });
+                    if (points.length) {
+                        const cutoff = points[points.length - 1][0] - parseFloat(feed.dataset.chartWindow) * 1000;
+                        while (series.data.length && series.data[0].x < cutoff) {
+                            series.data[0].remove(false);
+                        }
+                    }
+                });
+            }
+            chart.redraw(false);
+        });
+    }, 100);
+})();
+</script>
+"""
+
+CHART_UPDATES = itertools.count()
+
+CHART_WINDOWS = {
+    60: '1 min',
+    600: '10 min',
+    3600: '60 min',
+}
+
 STATUS_MAPS = {
             'inuse': 'Treadmill Running',
             'paused': 'Paused',
             'walk': 'Walk',
             'idle': 'Treadmill Controller',
             'finished': 'Finished',
+            'connecting': 'Connecting',
+            'offline': 'Treadmill Offline',
         }
 
-THREADS = []
-def disown(fn):
-    global THREADS
-    # Launch new thread
-    t = threading.Thread(target=fn)
-    THREADS.append(t)
-    t.daemon = True
-    t.start()
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+DEFAULT_AGGREGATES = 'duration,distance,elevation_gain,avg_speed,avg_grade'
+
+def parse_duration(text):
+    """ Seconds in '90', '15m', '7d' and so on
+    """
+    text = text.strip()
+    if text and text[-1] in DURATION_UNITS:
+        return float(text[:-1]) * DURATION_UNITS[text[-1]]
+    return float(text)
+
+def format_pace(seconds):
+    """ Seconds per km as mm:ss
+    """
+    if not seconds:
+        return "--:--"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+def workout_renderers(state, distance, elevation_gain, pace, mets, calories):
+    """ Renders the workout totals published by the device into labels
+    """
+    state.register('distance', lambda value: distance.set_text(f"{value:.2f} km"))
+    state.register('elevation_gain', lambda value: elevation_gain.set_text(f"{value} m up"))
+    state.register('pace', lambda value: pace.set_text(f"{format_pace(value)} /km"))
+    state.register('mets', lambda value: mets.set_text(f"{value:.1f} METs"))
+    state.register('calories', lambda value: calories.set_text(f"{value} kcal"))
+
+def workout_labels(classes):
+    """ A row of labels for workout_renderers()
+    """
+    with ui.row():
+        return [
+            ui.label(text).classes(classes)
+            for text in ("0.00 km", "0 m up", "--:-- /km", "1.0 METs", "0 kcal")
+        ]
+
+def format_elapsed(elapsed):
+    minutes = int(elapsed / 60)
+    seconds = elapsed - minutes * 60
+    return f"{minutes:02d}:{seconds:05.02f}"
+
+def start_timer(element, elapsed:float, direction:int=1):
+    """ Hands the clock over to the browser, see timer_script
+    """
+    element.text = format_elapsed(max(elapsed, 0))
+    element.props(
+        f"data-timer-token={next(TIMER_TOKENS)} "
+        f"data-timer-elapsed={elapsed:.3f} "
+        f"data-timer-direction={direction}"
+    )
+
+def stop_timer(element):
+    element.props(remove="data-timer-token data-timer-elapsed data-timer-direction")
+
+def outbox_backlog(client):
+    """ How many updates NiceGUI has queued for `client` and not sent yet.
+        The outbox is per client from NiceGUI 1.4, and one shared queue
+        keyed by client id before that
+    """
+    client_outbox = getattr(client, 'outbox', None)
+    if client_outbox is not None:
+        return len(client_outbox.updates) + len(client_outbox.messages)
+    from nicegui import outbox
+    return len(outbox.update_queue.get(client.id, ())) \
+         + sum(1 for message in outbox.message_queue if message[0] == client.id)
+
+def render_snapshot(subscription, state, client=None):
+    """ Renders the newest snapshot, if there is one. Whatever was
+        published between two refreshes is never sent to this page, and
+        while the page's browser still hasn't been sent the last render
+        it's skipped again, so a slow browser only ever gets the newest
+    """
+    if client is not None and outbox_backlog(client):
+        return
+    snapshot = subscription.poll()
+    if snapshot is None:
+        return
+    for field, value in snapshot.items():
+        if field in state.renderers:
+            state.set(field, value)
+    state.flush()
+
+
+class ControlPage:
+    """ The control page as one browser sees it, for one device. Every
+        client gets its own widgets, subscription and view state
+    """
+    def __init__(self, handler, device, client):
+        self.handler = handler
+        self.service = device
+        self.client = client
+        self.bindings = handler.bindings
+        self.programs = handler.programs
+
+        # Longer chart windows than fit in `chart_max_points` raw polls are
+        # downsampled and redrawn every `chart_refresh` seconds
+        self.chart_window = min(CHART_WINDOWS)
+        self.chart_seq = 0
+        self.chart_reset = True
+        self.chart_last_reset = 0.0
+
+        # Widgets are only updated through the view state, at most
+        # `max_rate` times a second, from the snapshots the device publishes
+        self.subscription = STATE.subscribe(device.name)
+        self.state = ViewState()
+        # Set while the number inputs are updated from a poll, so their
+        # on_change doesn't send the polled value back as a new target
+        self._rendering = False
+        self.state.register('status', self.update_status)
+        self.state.register('speed', self.update_speed)
+        self.state.register('grade', self.update_grade)
+        self.state.register('elapsed_start', self.render_elapsed)
+        self.state.register('hiit_end', self.render_hiit)
 
-    # Clear out old threads
-    THREADS = [thread for thread in THREADS if thread.is_alive()]
+        self._state_running = True
 
-class UI:
-    def __init__(self, service):
-        self.ui = ui
         self.setup()
-        self.service = service
-
-        self._state_running = True
 
     def on_grade_change(self, e):
-        disown( lambda *a: self.service.grade_change(e.value) )
+        # Setting the value from a poll fires this too, only edits count
+        if self._rendering or e.value == self.state.rendered.get('grade'):
+            return
+        self.service.grade_change(e.value)
 
     def on_speed_change(self, e):
-        disown( lambda *a: self.service.speed_change(e.value) )
+        if self._rendering or e.value == self.state.rendered.get('speed'):
+            return
+        self.service.speed_change(e.value)
 
-    def on_press_go(self):
-        disown( self.service.go_start )
+    async def on_press_go(self):
+        await self.service.go_start()
 
     def on_press_stop(self):
-        disown( self.service.go_stop )
+        self.service.go_stop()
 
     def on_run_walk_button(self):
         """ Handles when the run or walk button is pressed
@@ -121,11 +328,11 @@ class UI:
         if self._state_running:
             self._walk_run_button.props("icon=directions_run")
             self._walk_run_button.text = 'Run'
-            disown( self.service.go_walk )
+            self.service.go_walk()
         else:
             self._walk_run_button.props("icon=directions_walk")
             self._walk_run_button.text = 'Walk'
-            disown( self.service.go_run )
+            self.service.go_run()
         self._state_running = not self._state_running
 
     def generate_speed_delta(self, delta):
@@ -139,20 +346,21 @@ class UI:
         self._title_label.update()
 
     def update_speed(self, new_value):
-        self._speed_display.value = new_value
+        self._rendering = True
+        try:
+            self._speed_display.value = new_value
+        finally:
+            self._rendering = False
         self._speed_display.update()
 
     def update_grade(self, new_value):
-        self._grade_display.value = new_value
+        self._rendering = True
+        try:
+            self._grade_display.value = new_value
+        finally:
+            self._rendering = False
         self._grade_display.update()
 
-    def update_elapsed(self, elapsed):
-        minutes = int(elapsed / 60)
-        seconds = elapsed - minutes * 60
-        elapsed_text = f"{minutes:02d}:{seconds:05.02f}"
-        self._elapsed_label.text = elapsed_text
-        self._elapsed_label.update()
-
     def hiit_show(self):
         if not self._hiit_label.visible:
             self._hiit_label.visible = True
@@ -161,54 +369,44 @@ class UI:
         if self._hiit_label.visible:
             self._hiit_label.visible = False
 
-    def hiit_update_elapsed(self, elapsed:float):
-        minutes = int(elapsed / 60)
-        seconds = elapsed - minutes * 60
-        elapsed_text = f"{minutes:02d}:{seconds:05.02f}"
-        self._hiit_label.text = elapsed_text
-        self._hiit_label.update()
-
-    def hiit_pulse(self):
-        self.service.go_hiit(
-            speed=8.0,
-            duration=60.0,
-        )
+    def render_elapsed(self, start_tic):
+        if start_tic is None:
+            # Freeze the clock where it got to
+            previous = self.state.rendered.get('elapsed_start')
+            if previous:
+                self._elapsed_label.text = format_elapsed(time.time() - previous)
+            stop_timer(self._elapsed_label)
+        else:
+            start_timer(self._elapsed_label, time.time() - start_tic)
+
+    def refresh_view(self):
+        render_snapshot(self.subscription, self.state, self.client)
 
-    def on_hiit_pulse(self):
-        disown( self.hiit_pulse )
+    def render_hiit(self, end_tic):
+        if end_tic is None:
+            stop_timer(self._hiit_label)
+            self.hiit_hide()
+        else:
+            start_timer(self._hiit_label, end_tic - time.time(), -1)
+            self.hiit_show()
 
-    def setting_1(self):
-        self.service.grade_change(15)
-        self.service.speed_change(4)
+    def generate_program(self, name):
+        return lambda *a: self.service.go_program(name)
 
-    def setting_2(self):
-        self.service.grade_change(15)
-        self.service.speed_change(5.0)
+    def generate_action(self, action, value=None):
+        return lambda *a: self.bindings.run(self.service, action, value)
 
     def setup(self):
         ui.add_head_html(style)
+        ui.add_head_html(timer_script)
+        ui.add_head_html(chart_script)
+        ui.timer(1 / self.handler.max_rate, self.refresh_view)
 
         with ui.card().tight():
+            self.setup_device_selector()
             self._title_label = ui.label("Treadmill Controller").style('font-size: 200%; font-weight: 300; text-align: center')
 
-            '''
-            chart = ui.chart({
-                'title': False,
-                'chart': {'type': 'spline'},
-                'yAxis': {
-                    'title': {
-                        'text': ''
-                    },
-                },
-                'xAxis': {
-                    'categories': ['A', 'B']
-                },
-                'series': [
-                    {'name': 'Speed', 'data': [0.1, 0.2]},
-                    {'name': 'Incline', 'data': [0.3, 0.4]},
-                ],
-            }).classes('w-full h-64 highcharts-dashboards-dark')
-            '''
+            self.setup_chart()
 
             # Now let's include the action buttons bar
             with ui.card_section():
@@ -222,27 +420,18 @@ class UI:
                     with ui.column().classes('items-stretch'):
                         ui.button('Stop', icon='stop', on_click=self.on_press_stop)
 
-                with ui.row().classes('pt-3 m-auto'):
-                    with ui.column().classes('items-stretch'):
-                        ui.button(
-                            'Normal',
-                            icon='looks_one',
-                            on_click=self.setting_1,
-                        )
+                self.handler.action_buttons(self)
 
-                    with ui.column().classes('items-stretch'):
-                        ui.button(
-                            'HIIT IT',
-                            icon='keyboard_double_arrow_right',
-                            on_click=self.on_hiit_pulse,
-                        )
-
-                    with ui.column().classes('items-stretch'):
-                        ui.button(
-                            'Fast',
-                            icon='looks_two',
-                            on_click=self.setting_2,
-                        )
+                # Programs from programs.yaml
+                if self.programs:
+                    with ui.row().classes('pt-3 m-auto'):
+                        for name in self.programs:
+                            with ui.column().classes('items-stretch'):
+                                ui.button(
+                                    name,
+                                    icon='directions_run',
+                                    on_click=self.generate_program(name),
+                                )
 
             # Main part allowing changes to grade and speed
             with ui.card_section():
@@ -254,6 +443,7 @@ class UI:
                                              .classes('text-6xl font-mono') \
                                              .style("color: #ff2222")
                         self._hiit_label.visible = False
+                        workout_renderers(self.state, *workout_labels('text-xl font-mono'))
 
             with ui.card_section():
                 with ui.row():
@@ -292,7 +482,319 @@ class UI:
         dark = ui.dark_mode()
         dark.enable()
 
-    def run(self):
+    def setup_device_selector(self):
+        """ Links to the other treadmills' control pages, when there's
+            more than one
+        """
+        devices = self.handler.devices
+        if devices is None or len(devices) < 2:
+            return
+        with ui.row().classes('pt-3 m-auto'):
+            for device in devices:
+                if device is self.service:
+                    ui.label(device.name).style('font-weight: 600')
+                else:
+                    ui.link(device.name, f'/device/{device.name}')
+
+    def setup_chart(self):
+        self._chart = ui.chart({
+            'title': False,
+            'chart': {'type': 'spline', 'animation': False},
+            'time': {'useUTC': False},
+            'credits': {'enabled': False},
+            'legend': {'enabled': True},
+            'plotOptions': {'series': {'marker': {'enabled': False}, 'animation': False}},
+            'xAxis': {'type': 'datetime'},
+            'yAxis': [
+                {'title': {'text': 'km/h'}, 'min': 0},
+                {'title': {'text': '%'}, 'min': 0, 'opposite': True},
+            ],
+            'series': [
+                {'name': 'Speed', 'data': []},
+                {'name': 'Incline', 'data': [], 'yAxis': 1},
+            ],
+        }).classes('w-full h-64 highcharts-dashboards-dark')
+        self._chart_feed = ui.element('div') \
+                             .style('display: none') \
+                             .props(f'data-chart-for=c{self._chart.id}')
+        with ui.row().classes('m-auto'):
+            ui.toggle(CHART_WINDOWS, value=self.chart_window, on_change=self.on_chart_window)
+
+        ui.timer(1.0, self.update_chart)
+
+    def on_chart_window(self, event):
+        self.chart_window = event.value
+        self.chart_reset = True
+
+    def send_chart(self, mode, samples, max_points=None):
+        speed = [(round(t * 1000), round(v, 1)) for t, v, _ in samples]
+        grade = [(round(t * 1000), round(v, 2)) for t, _, v in samples]
+        if max_points:
+            speed = lttb(speed, max_points)
+            grade = lttb(grade, max_points)
+        self._chart_feed.props(
+            f"data-chart-seq={next(CHART_UPDATES)} "
+            f"data-chart-mode={mode} "
+            f"data-chart-window={self.chart_window} "
+            f'data-chart-speed="{json.dumps(speed, separators=(",", ":"))}" '
+            f'data-chart-grade="{json.dumps(grade, separators=(",", ":"))}"'
+        )
+
+    def update_chart(self):
+        """ Sends the chart whatever it hasn't seen yet from the device's
+            history. Nothing is lost while the browser is behind, the next
+            update sends everything since the last one it got
+        """
+        if outbox_backlog(self.client):
+            return
+        history = self.service.history
+        now = time.monotonic()
+        chart_max_points = self.handler.chart_max_points
+        downsample = self.chart_window / self.service.poll_interval > chart_max_points
+
+        if not self.chart_reset and not downsample:
+            self.chart_seq, samples = history.since(self.chart_seq)
+            if samples:
+                self.send_chart('append', samples)
+            return
+        if not self.chart_reset and now - self.chart_last_reset < self.handler.chart_refresh:
+            return
+
+        self.chart_seq, samples = history.window(self.chart_window)
+        self.send_chart('reset', samples, chart_max_points if downsample else None)
+        self.chart_reset = False
+        self.chart_last_reset = now
+
+
+class UI:
+    def __init__(self, service, bindings, devices=None, max_rate=5.0, programs=None,
+                 chart_max_points=600, chart_refresh=10.0, spectator_rate=2.0,
+                 timeseries=None):
+        self.ui = ui
+        self.service = service
+        self.programs = programs or {}
+        self.bindings = bindings
+        bindings.on_reload(self.action_buttons.refresh)
+
+        self.chart_max_points = chart_max_points
+        self.chart_refresh = chart_refresh
+
+        # Control pages render at most `max_rate` times a second, read only
+        # pages follow at `spectator_rate`
+        self.max_rate = max_rate
+        self.spectator_rate = spectator_rate
+
+        self.devices = devices
+        self.setup()
+        if devices is not None:
+            self.setup_dashboard()
+            self.setup_spectator()
+        self.setup_metrics()
+        self.setup_log_page()
+        self.timeseries = timeseries
+        if timeseries is not None:
+            self.setup_history_api()
+
+    @ui.refreshable
+    def action_buttons(self, page):
+        """ The row of buttons configured in app.conf on one control page,
+            redrawn on every page when it changes
+        """
+        with ui.row().classes('pt-3 m-auto'):
+            for button in self.bindings.buttons:
+                with ui.column().classes('items-stretch'):
+                    ui.button(
+                        button.get('label', button['action']),
+                        icon=button.get('icon'),
+                        on_click=page.generate_action(button['action'], button.get('value')),
+                    )
+
+    def setup(self):
+        """ The control page at /, for the primary treadmill, and at
+            /device/<name> for each of the others
+        """
+        devices = self.devices
+
+        @ui.page('/')
+        def control(client: Client):
+            ControlPage(self, self.service, client)
+
+        if devices is None:
+            return
+
+        @ui.page('/device/{name}')
+        def device_control(client: Client, name: str):
+            try:
+                device = devices.get(name)
+            except KeyError:
+                ui.label(f"No treadmill called {name}")
+                return
+            ControlPage(self, device, client)
+
+    def setup_dashboard(self):
+        """ Overview of every treadmill at /dashboard, each linking to its
+            control page
+        """
+        devices = self.devices
+
+        @ui.page('/dashboard')
+        def dashboard(client: Client):
+            ui.add_head_html(style)
+            ui.add_head_html(timer_script)
+            ui.dark_mode().enable()
+            states = []
+            with ui.row():
+                for device in devices:
+                    with ui.card().tight():
+                        with ui.card_section():
+                            ui.link(device.name, f'/device/{device.name}').style('font-size: 150%; font-weight: 300')
+                            status = ui.label('Connecting')
+                            elapsed = ui.label('00:00.00').classes('text-4xl font-mono')
+                            speed = ui.label('')
+                            grade = ui.label('')
+                    states.append(self.spectator_state(device.name, status, elapsed, speed, grade))
+
+            def refresh():
+                for subscription, state in states:
+                    render_snapshot(subscription, state, client)
+
+            ui.timer(1 / self.spectator_rate, refresh)
+
+    def setup_spectator(self):
+        """ Read only big screen view of one treadmill at /watch, the
+            primary one unless ?device= names another
+        """
+        devices = self.devices
+
+        @ui.page('/watch')
+        def watch(client: Client, device: str = None):
+            ui.add_head_html(style)
+            ui.add_head_html(timer_script)
+            ui.dark_mode().enable()
+            try:
+                target = devices.get(device) if device else devices.primary
+            except KeyError:
+                ui.label(f"No treadmill called {device}")
+                return
+            with ui.column().classes('w-full items-center'):
+                ui.label(target.name).style('font-size: 200%; font-weight: 300')
+                status = ui.label('Connecting').style('font-size: 300%')
+                elapsed = ui.label('00:00.00').classes('text-8xl font-mono')
+                hiit = ui.label('00:00.00').classes('text-6xl font-mono').style('color: #ff0000')
+                hiit.visible = False
+                speed = ui.label('').classes('text-6xl')
+                grade = ui.label('').classes('text-6xl')
+                workout = workout_labels('text-4xl font-mono')
+            subscription, state = self.spectator_state(target.name, status, elapsed, speed, grade, hiit)
+            workout_renderers(state, *workout)
+            ui.timer(1 / self.spectator_rate, lambda: render_snapshot(subscription, state, client))
+
+    def spectator_state(self, device, status, elapsed, speed, grade, hiit=None):
+        """ A subscription and view state rendering one device's snapshots
+            into a read only page's labels
+        """
+        state = ViewState()
+
+        def render_status(value):
+            status.text = STATUS_MAPS.get(value) or value or 'Connecting'
+
+        def render_elapsed(start_tic):
+            if start_tic is None:
+                previous = state.rendered.get('elapsed_start')
+                if previous:
+                    elapsed.text = format_elapsed(time.time() - previous)
+                stop_timer(elapsed)
+            else:
+                start_timer(elapsed, time.time() - start_tic)
+
+        def render_hiit(end_tic):
+            if end_tic is None:
+                stop_timer(hiit)
+                hiit.visible = False
+            else:
+                start_timer(hiit, end_tic - time.time(), -1)
+                hiit.visible = True
+
+        state.register('status', render_status)
+        state.register('elapsed_start', render_elapsed)
+        state.register('speed', lambda value: speed.set_text(f"SPEED {value or 0.0:.1f} km/h"))
+        state.register('grade', lambda value: grade.set_text(f"INCLINE {value or 0.0:.1f} %"))
+        if hiit is not None:
+            state.register('hiit_end', render_hiit)
+        return STATE.subscribe(device), state
+
+    def setup_log_page(self):
+        """ The most recent log messages at /log, followed live
+        """
+        @ui.page('/log')
+        def log_page():
+            ui.add_head_html(style)
+            ui.dark_mode().enable()
+            view = ui.log(max_lines=RECENT.records.maxlen).classes('w-full h-screen')
+            last_seq = 0
+
+            def refresh():
+                nonlocal last_seq
+                for entry in RECENT.since(last_seq):
+                    stamp = time.strftime('%H:%M:%S', time.localtime(entry['time']))
+                    view.push(f"{stamp} {entry['level']:<7} {entry['name']}: {entry['message']}")
+                    last_seq = entry['seq']
+
+            refresh()
+            ui.timer(1.0, refresh)
+
+    def setup_metrics(self):
+        """ Serves the metrics for prometheus on /metrics
+        """
+        @nicegui_app.get('/metrics')
+        def metrics():
+            if not METRICS.enabled:
+                return PlainTextResponse("metrics are disabled\n", status_code=404)
+            return PlainTextResponse(METRICS.expose(), media_type='text/plain; version=0.0.4')
+
+    def setup_history_api(self):
+        """ Serves the local history as JSON on /api/history, see TimeSeries.
+            The range is `start` and `end` in seconds since the epoch, or the
+            `last` 15m, 7d etc. `bucket` (or `points`, the most buckets wanted)
+            adds a downsampled series, and `aggregates` picks the columns
+        """
+        timeseries = self.timeseries
+
+        # Runs on fastapi's thread pool since it isn't async, so a slow
+        # query never holds up the event loop
+        @nicegui_app.get('/api/history')
+        def history(start: str = None, end: str = None, last: str = None,
+                    device: str = None, session: str = None, bucket: str = None,
+                    points: int = None, aggregates: str = DEFAULT_AGGREGATES):
+            try:
+                names = [name.strip() for name in aggregates.split(',') if name.strip()]
+                if last is not None:
+                    span = parse_duration(last)
+                    # Rounded so repeated requests can be served from the cache
+                    step = parse_duration(bucket) if bucket else 10.0
+                    end_time = math.ceil(time.time() / step) * step
+                    start_time = end_time - span
+                elif start is not None:
+                    start_time = float(start)
+                    end_time = float(end) if end is not None else time.time()
+                elif session is not None:
+                    start_time, end_time = 0.0, math.ceil(time.time() / 10.0) * 10.0
+                else:
+                    raise ValueError("give a range with start and end, or last")
+                bucket_size = parse_duration(bucket) if bucket else None
+                if bucket_size is None and points:
+                    bucket_size = max(math.ceil((end_time - start_time) / points), 1)
+                return timeseries.query(start_time, end_time, names, device=device,
+                                        session=session, bucket=bucket_size)
+            except ValueError as ex:
+                return JSONResponse({'error': str(ex), 'aggregates': list(AGGREGATES)}, status_code=400)
+
+    def run(self, on_startup=None):
+        """ Runs the NiceGUI server on this thread. `on_startup` is
+            called once its event loop is up
+        """
+        if on_startup:
+            nicegui_app.on_startup(on_startup)
         ui.run(reload=False)
 
 
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from app.metrics import UI_FLUSH, UI_UPDATES
+
+MISSING = object()
+
+class ViewState:
+    """ Sits between the monitor and the widgets. Fields are set as often as
+        we like, but a widget is only touched when its value differs from the
+        last one rendered, and changed fields are rendered together once per
+        frame by flush(), which the UI calls on a timer at the max rate.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.renderers = {}
+        self.rendered = {}
+        self.pending = {}
+
+    def register(self, field, render):
+        """ `render(value)` is called from flush() whenever `field` changes
+        """
+        self.renderers[field] = render
+
+    def set(self, field, value):
+        """ Records the latest value for a field. Safe from any thread
+        """
+        with self.lock:
+            if self.rendered.get(field, MISSING) == value:
+                self.pending.pop(field, None)
+            else:
+                self.pending[field] = value
+
+    def flush(self):
+        """ Renders every field that changed since the last flush
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if not pending:
+            return
+        tic = time.perf_counter()
+        for field, value in pending.items():
+            self.renderers[field](value)
+            self.rendered[field] = value
+            UI_UPDATES.inc(field)
+        UI_FLUSH.observe(time.perf_counter() - tic)
@@ -0,0 +1,115 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class EventWriter:
+    """ Takes events off a bounded in-memory queue and appends them to the
+        local spool in batches from its own thread. A batch is flushed when it
+        reaches `batch_size` events or when `flush_interval` seconds have
+        passed since the first event in it arrived.
+    """
+    def __init__(self, spool, max_queue=5000, batch_size=50, flush_interval=2.0):
+        self.spool = spool
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.pending = []
+
+    def put(self, speed:float, grade:float, device:str=None, session:str=None):
+        """ Queues an event. Never blocks: if the queue is full the oldest
+            event is thrown away to make room for the new one
+        """
+        self.enqueue(('event', (datetime.datetime.now(datetime.timezone.utc), speed, grade, device, session)))
+
+    def put_chunk(self, start:float, end:float, samples:int, payload:bytes, device:str=None):
+        """ Queues an encoded capture chunk, see app.capture
+        """
+        self.enqueue(('chunk', (start, end, samples, payload, device)))
+
+    def put_session(self, row):
+        """ Queues the latest summary of a workout session, see app.sessions
+        """
+        self.enqueue(('session', row))
+
+    def put_rollup(self, row):
+        """ Queues one minute of a workout session, see app.sessions
+        """
+        self.enqueue(('rollup', row))
+
+    def enqueue(self, event):
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def collect(self):
+        """ Blocks until there's a batch worth flushing and returns it
+        """
+        batch = self.pending
+        self.pending = []
+        deadline = None
+        if batch:
+            deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                event = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            batch.append(event)
+        return batch
+
+    def flush(self, batch):
+        try:
+            events = [row for kind, row in batch if kind == 'event']
+            chunks = [row for kind, row in batch if kind == 'chunk']
+            sessions = [row for kind, row in batch if kind == 'session']
+            rollups = [row for kind, row in batch if kind == 'rollup']
+            if events:
+                self.spool.append(events)
+            if chunks:
+                self.spool.append_chunks(chunks)
+            if sessions:
+                self.spool.append_sessions(sessions)
+            if rollups:
+                self.spool.append_rollups(rollups)
+        except Exception as ex:
+            log.error("Could not spool %d events: %s", len(batch), ex)
+            # Hang on to the batch for the next attempt but keep the
+            # total amount we're holding bounded
+            overflow = len(batch) - self.queue.maxsize
+            if overflow > 0:
+                batch = batch[overflow:]
+                self.dropped += overflow
+            self.pending = batch
+            time.sleep(self.flush_interval)
+
+    def writer_loop(self):
+        while True:
+            batch = self.collect()
+            if batch:
+                self.flush(batch)
+
+    def run(self):
+        """ Starts the writer thread
+        """
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+""" Benchmarks writing events to postgres, the way the spool drainer does:
+
+    - per event: one insert and commit per event, on a pooled connection
+    - multi-row: one insert statement built for each batch
+    - prepared pipeline: Database.write(), a prepared insert per event
+      sent in pipeline mode and committed once per batch
+
+    It works in a scratch schema that's dropped at the end, so it can point
+    at the real database. Needs psycopg and a server, e.g.
+
+        python -m bench.bench_db --conninfo "dbname=treadmill" --batch-size 100
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+from app.database import Database, INSERT_EVENT
+
+SCHEMA = 'treadmill_bench'
+
+def make_events(count, device='bench'):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [
+        (now + datetime.timedelta(seconds=i), 5.0, 1.5, device, None)
+        for i in range(count)
+    ]
+
+def setup_schema(conninfo):
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(f"drop schema if exists {SCHEMA} cascade")
+        conn.execute(f"create schema {SCHEMA}")
+        conn.execute(
+            f"""
+            create table {SCHEMA}.events (
+                id bigserial primary key,
+                timestamp timestamptz not null,
+                speed real not null,
+                grade real not null,
+                device text,
+                session text
+            )
+            """
+        )
+
+def drop_schema(conninfo):
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(f"drop schema if exists {SCHEMA} cascade")
+
+def run(name, insert, events, duration):
+    """ Calls insert(events) for `duration` seconds and prints the rate
+        and the time per batch
+    """
+    batches = 0
+    tic = time.monotonic()
+    while time.monotonic() - tic < duration:
+        insert(events)
+        batches += 1
+    elapsed = time.monotonic() - tic
+    print(
+        f"{name:>18}: {batches * len(events) / elapsed:9.0f} events/s"
+        f" {elapsed / batches * 1000:8.2f} ms/batch"
+    )
+
+def per_event(db):
+    def insert(events):
+        for event in events:
+            db.run_query(INSERT_EVENT, event)
+    return insert
+
+def multi_row(db):
+    def insert(events):
+        values = []
+        params = {}
+        for i, (timestamp, speed, grade, device, session) in enumerate(events):
+            values.append(f"( %(timestamp{i})s, %(speed{i})s, %(grade{i})s, %(device{i})s, %(session{i})s )")
+            params[f"timestamp{i}"] = timestamp
+            params[f"speed{i}"] = speed
+            params[f"grade{i}"] = grade
+            params[f"device{i}"] = device
+            params[f"session{i}"] = session
+        db.run_query(
+            f"""
+            insert into events
+            ( timestamp, speed, grade, device, session )
+            values
+            {", ".join(values)}
+            """,
+            params
+        )
+    return insert
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--conninfo', required=True, help="postgres to benchmark against")
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    # Everything the Database does lands in the scratch schema
+    conninfo = make_conninfo(args.conninfo, options=f"-c search_path={SCHEMA}")
+    setup_schema(args.conninfo)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(
+                    conninfo,
+                    spool_path=os.path.join(tmp, 'bench.db'),
+                    history_path=os.path.join(tmp, 'history.db'),
+                )
+            db.connect()
+            events = make_events(args.batch_size)
+            print(f"batches of {args.batch_size} events")
+            run("per event", per_event(db), events, args.duration)
+            run("multi-row", multi_row(db), events, args.duration)
+            run("prepared pipeline", db.inject_events, events, args.duration)
+            db.pool.close()
+    finally:
+        drop_schema(args.conninfo)
+
+if __name__ == '__main__':
+    main()
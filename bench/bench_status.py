@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+""" Compares the status poll rate of one command per frame (how the csafe
+    Controller polls) against the batched single frame poll, on a simulated
+    9600 baud serial port.
+
+    Run from the repository root:
+
+        python -m bench.bench_status --polls 50 --latency 0.02
+"""
+
+import argparse
+import time
+
+from app import csafe_frames as cf
+from app.sim import SimulatedSerial
+
+def poll_sequential(transport):
+    state, _ = cf.query(transport, [cf.CMD_GET_STATUS])
+    _, speed = cf.query(transport, [cf.CMD_GET_SPEED])
+    _, grade = cf.query(transport, [cf.CMD_GET_GRADE])
+    return {
+        'status': state,
+        'speed': cf.parse_measurement(speed[cf.CMD_GET_SPEED]),
+        'grade': cf.parse_measurement(grade[cf.CMD_GET_GRADE]),
+    }
+
+def poll_batched(transport):
+    return cf.query_status(transport)
+
+def measure(poll, transport, polls):
+    tic = time.perf_counter()
+    for _ in range(polls):
+        poll(transport)
+    elapsed = time.perf_counter() - tic
+    return polls / elapsed, elapsed / polls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--polls', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="treadmill turnaround time in seconds")
+    parser.add_argument('--jitter', type=float, default=0.005)
+    args = parser.parse_args()
+
+    transport = SimulatedSerial(latency=args.latency, jitter=args.jitter)
+    for name, poll in (('sequential', poll_sequential), ('batched', poll_batched)):
+        rate, per_poll = measure(poll, transport, args.polls)
+        print(f"{name:>10}: {rate:6.1f} polls/s {per_poll*1000:7.1f} ms/poll")
+
+if __name__ == '__main__':
+    main()
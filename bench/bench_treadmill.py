@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+""" Benchmarks the treadmill stack against a simulated treadmill served on
+    a pty, so none of it needs the real hardware:
+
+    - poll rate: status polls per second through the CommandDispatcher
+    - command latency: from a set_speed request until a poll reports it
+    - insert throughput: events per second into the local spool, and into
+      postgres when --conninfo is given
+
+    Before any of that it checks that the simulated belt reaches a new speed
+    when it's polled every --poll-interval seconds.
+
+    Run from the repository root:
+
+        python -m bench.bench_treadmill --duration 5 --latency 0.02
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+import serial
+
+from app import csafe_frames as cf
+from app.dispatcher import CommandDispatcher
+from app.sim import PtyTreadmill, SimulatedTreadmill
+from app.spool import Spool
+from app.treadmill import Treadmill, load_gpio
+
+def check_ramp(acceleration, interval, speed=4.0):
+    """ Polls a simulated belt every `interval` seconds until it reaches
+        `speed`, which has to happen within twice the time the acceleration
+        takes
+    """
+    treadmill = SimulatedTreadmill(state='inuse', acceleration=acceleration)
+    treadmill.handle(bytes([cf.CMD_SET_SPEED, 3, round(speed * 10), 0, 0x31]))
+    expected = speed / acceleration if acceleration else 0.0
+    tic = time.monotonic()
+    while time.monotonic() - tic < 2 * expected + 1.0:
+        time.sleep(interval)
+        response = treadmill.handle(bytes([cf.CMD_GET_SPEED]))
+        if response[3] | (response[4] << 8) == round(speed * 10):
+            print(f"ramp check: {speed} km/h in {time.monotonic() - tic:.2f} s, expected {expected:.2f} s")
+            return True
+    print(f"ramp check: FAILED, the belt is at {treadmill.speed / 10:.1f} km/h instead of {speed} km/h")
+    return False
+
+def bench_poll_rate(dispatcher, duration):
+    polls = 0
+    tic = time.monotonic()
+    while time.monotonic() - tic < duration:
+        dispatcher.poll()
+        polls += 1
+    elapsed = time.monotonic() - tic
+    print(f"poll rate: {polls / elapsed:6.1f} polls/s")
+
+def bench_command_latency(dispatcher, commands, timeout=10.0):
+    latencies = []
+    for i in range(commands):
+        speed = 3.0 + (i % 2)
+        tic = time.monotonic()
+        dispatcher.set_speed(speed)
+        while time.monotonic() - tic < timeout:
+            status, _, _ = dispatcher.poll()
+            if status and round(status['speed'], 1) == speed:
+                latencies.append(time.monotonic() - tic)
+                break
+    if not latencies:
+        print("command latency: no commands took effect")
+        return
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+    print(
+        f"command latency: median {statistics.median(latencies)*1000:6.1f} ms"
+        f" p95 {p95*1000:6.1f} ms over {len(latencies)} commands"
+    )
+
+def make_events(count, device='bench'):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [(now, 5.0, 1.5, device, None) for _ in range(count)]
+
+def bench_spool(duration, batch_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        spool = Spool(os.path.join(tmp, 'bench.db'))
+        events = make_events(batch_size)
+        inserted = 0
+        tic = time.monotonic()
+        while time.monotonic() - tic < duration:
+            spool.append(events)
+            inserted += batch_size
+        elapsed = time.monotonic() - tic
+    print(f"spool inserts: {inserted / elapsed:9.0f} events/s (batches of {batch_size})")
+
+def bench_postgres(conninfo, duration, batch_size):
+    # Only needed when there's a server to talk to
+    from app.database import Database
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(
+                conninfo,
+                spool_path=os.path.join(tmp, 'bench.db'),
+                history_path=os.path.join(tmp, 'history.db'),
+            )
+        events = make_events(batch_size)
+        inserted = 0
+        tic = time.monotonic()
+        while time.monotonic() - tic < duration:
+            db.inject_events(events)
+            inserted += batch_size
+        elapsed = time.monotonic() - tic
+    print(f"postgres inserts: {inserted / elapsed:9.0f} events/s (batches of {batch_size})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--commands', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="treadmill turnaround time in seconds")
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--acceleration', type=float, default=0.0,
+                        help="belt acceleration in km/h per second, 0 is instant")
+    parser.add_argument('--poll-interval', type=float, default=0.1,
+                        help="poll interval for the ramp check, as poll_fast_interval")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--conninfo', help="postgres to benchmark inserts against")
+    args = parser.parse_args()
+
+    check_ramp(args.acceleration or 2.0, args.poll_interval)
+
+    simulator = PtyTreadmill(
+                    SimulatedTreadmill(state='inuse', acceleration=args.acceleration),
+                    latency=args.latency,
+                    jitter=args.jitter,
+                )
+    transport = serial.Serial(simulator.run(), 9600, timeout=0.2)
+    load_gpio(simulate=True)
+    dispatcher = CommandDispatcher(Treadmill(transport))
+    dispatcher.run()
+
+    bench_poll_rate(dispatcher, args.duration)
+    bench_command_latency(dispatcher, args.commands)
+    bench_spool(args.duration, args.batch_size)
+    if args.conninfo:
+        bench_postgres(args.conninfo, args.duration, args.batch_size)
+
+if __name__ == '__main__':
+    main()